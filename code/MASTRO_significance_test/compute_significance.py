@@ -1,13 +1,23 @@
 import glob
 import os
 import re
+import time
 
 import numpy as np
 import math
 import networkx as nx
 import itertools
+import pickle
+from multiprocessing import Pool
 from filelock import FileLock
 from read_input_dags import read_multiple_graphs_per_evolution
+from cohort import Cohort, iter_bits
+
+# counts of induced embeddings keyed by ("embeddings", trajectory shape, graph shape) and of automorphisms keyed by
+# ("automorphisms", trajectory shape), shared by all trajectories and graphs of the same canonical shape
+shape_counts = dict()
+# counts computed since the last call of pop_new_shape_counts, which workers send back to the main process
+new_shape_counts = dict()
 
 
 def print_graph(tree):
@@ -70,6 +80,125 @@ def compute_support(traj, graphs_list):
 def findsubsets(set, subset_size):
     return list(itertools.combinations(set, subset_size))
 
+def poset_bitsets(graph_):
+    # nodes without the germline root "0" and bitsets of successors and predecessors of each node among them
+    nodes = [node for node in graph_.nodes if node != "0"]
+    index = {node: i for i, node in enumerate(nodes)}
+    succ = [0]*len(nodes)
+    pred = [0]*len(nodes)
+    for u, v in graph_.edges:
+        if u in index and v in index:
+            succ[index[u]] |= 1 << index[v]
+            pred[index[v]] |= 1 << index[u]
+    return nodes, succ, pred
+
+def embedding_order(succ , pred):
+    """
+    Order of the pattern nodes for the embedding search. Twins (same successors and predecessors, hence incomparable)
+    are placed next to each other and the largest twin class is placed last; before, the next class is the one with most
+    relations to the nodes already placed. Returns the order, the first position of the last class and, per position,
+    the earlier positions that are successors, predecessors and incomparable and the previous twin position or -1.
+    """
+    classes = dict()
+    for u in range(len(succ)):
+        classes.setdefault((succ[u], pred[u]), []).append(u)
+    classes = list(classes.values())
+    last = max(classes, key=len) if classes else []
+    remaining = [c for c in classes if c is not last]
+    order = []
+    while remaining:
+        placed = sum(1 << u for u in order)
+        c = max(remaining, key=lambda c: (bin((succ[c[0]] | pred[c[0]]) & placed).count("1"), bin(succ[c[0]] | pred[c[0]]).count("1"), -c[0]))
+        remaining.remove(c)
+        order.extend(c)
+    tail = len(order)
+    order.extend(last)
+
+    steps = []
+    for i, u in enumerate(order):
+        after = [j for j in range(i) if pred[u] >> order[j] & 1]
+        before = [j for j in range(i) if succ[u] >> order[j] & 1]
+        incomparable = [j for j in range(i) if not (succ[u] | pred[u]) >> order[j] & 1]
+        twin = i-1 if i > 0 and succ[order[i-1]] == succ[u] and pred[order[i-1]] == pred[u] else -1
+        steps.append((after, before, incomparable, twin))
+    return order, tail, steps
+
+def count_antichains(cand , size , t_incomparable , memo):
+    # number of antichains of the given size among the target nodes in cand
+    if size == 0:
+        return 1
+    if size == 1:
+        return bin(cand).count("1")
+    key = (cand, size)
+    if key not in memo:
+        count = 0
+        rest = cand
+        while bin(rest).count("1") >= size:
+            low = rest & -rest
+            rest ^= low
+            count += count_antichains(rest & t_incomparable[low.bit_length()-1] , size-1 , t_incomparable , memo)
+        memo[key] = count
+    return memo[key]
+
+def count_ordered_embeddings(pattern , target):
+    """
+    Number of induced embeddings of the pattern poset into the target poset (both as returned by poset_bitsets) in which
+    the nodes of each twin class of the pattern are mapped to increasing target nodes. Twins can be permuted freely, so
+    every set of target nodes is counted once per automorphism of the pattern that is not a permutation of twins. The
+    last twin class is not enumerated but counted as antichains among its candidates.
+    """
+    _, p_succ, p_pred = pattern
+    _, t_succ, t_pred = target
+    order, tail, steps = embedding_order(p_succ , p_pred)
+    all_nodes = (1 << len(t_succ)) - 1
+    t_incomparable = [all_nodes & ~(t_succ[v] | t_pred[v] | 1 << v) for v in range(len(t_succ))]
+    # target nodes need at least the degrees of the pattern node they are mapped to
+    out_deg = [bin(b).count("1") for b in t_succ]
+    in_deg = [bin(b).count("1") for b in t_pred]
+    candidates = []
+    for u in order:
+        out_u, in_u = bin(p_succ[u]).count("1"), bin(p_pred[u]).count("1")
+        candidates.append(sum(1 << v for v in range(len(t_succ)) if out_deg[v] >= out_u and in_deg[v] >= in_u))
+    image = [0]*len(order)
+    memo = dict()
+
+    def extend(i , used):
+        if i == len(order):
+            return 1
+        after, before, incomparable, twin = steps[i]
+        cand = candidates[i] & ~used
+        for j in after:
+            cand &= t_succ[image[j]]
+        for j in before:
+            cand &= t_pred[image[j]]
+        for j in incomparable:
+            cand &= ~(t_succ[image[j]] | t_pred[image[j]])
+        if i == tail:
+            return count_antichains(cand , len(order)-tail , t_incomparable , memo)
+        if twin >= 0:
+            cand &= ~((1 << (image[twin]+1)) - 1)
+        count = 0
+        while cand:
+            low = cand & -cand
+            image[i] = low.bit_length() - 1
+            count += extend(i+1 , used | low)
+            cand ^= low
+        return count
+
+    return extend(0 , 0)
+
+def count_induced_subposets(trajectory , graph_):
+    """
+    Number of node subsets of graph_ (without the root) whose induced subgraph together with the root is isomorphic to
+    trajectory. The root is the only node preceding all others in both, so this is the number of induced embeddings
+    of the trajectory without root divided by its automorphisms, which are the embeddings into itself.
+    """
+    pattern = poset_bitsets(trajectory)
+    target = poset_bitsets(graph_)
+    if len(pattern[0]) > len(target[0]):
+        return 0
+    return count_ordered_embeddings(pattern , target) // count_ordered_embeddings(pattern , pattern)
+
 def chernoffbound(p_mean , n , freq_traj):
     if freq_traj <= p_mean:
         return 1.
@@ -81,37 +210,32 @@ def chernoffbound(p_mean , n , freq_traj):
     pval_chern = ( (p_mean/freq_traj)**(freq_traj) * (q_/(1-freq_traj))**(1-freq_traj) )**n
     return pval_chern
 
+def compute_pvalues_fast(probs_list , supps):
+    """
+    Upper tails P(X >= supp) of the Poisson binomial distributions of several probability vectors, e.g. of all tests of a
+    trajectory. The distributions of the number of occurrences are computed together by the rolling dynamic program over
+    the graphs, each graph is one vectorized update of a (vectors, graphs+1) array, so memory is linear in the number of
+    graphs. Zero probabilities are skipped, the results equal the full matrix dynamic program up to rounding.
+    """
+    probs_list = [[p_ for p_ in probs if p_ > 0] for probs in probs_list]
+    for probs, supp_traj in zip(probs_list, supps):
+        if len(probs) < supp_traj:
+            print("Problem! n_traj < supp_traj , n_traj",len(probs),"supp_traj",supp_traj)
+    n_max = max([len(probs) for probs in probs_list] + [0])
+    # shorter vectors are padded with probability 0, which keeps their distribution
+    padded = np.zeros((len(probs_list), n_max))
+    for i, probs in enumerate(probs_list):
+        padded[i, :len(probs)] = probs
+    probs_dyn = np.zeros((len(probs_list), n_max+1))
+    probs_dyn[:, 0] = 1.
+    for i in range(n_max):
+        p_ = padded[:, i:i+1]
+        probs_dyn[:, 1:i+2] = p_*probs_dyn[:, 0:i+1] + (1-p_)*probs_dyn[:, 1:i+2]
+        probs_dyn[:, 0] *= 1-p_[:, 0]
+    return [probs_dyn[i, supp_traj:].sum() for i, supp_traj in enumerate(supps)]
+
 def compute_pvalue_fast(probs , supp_traj , debug_pval=0):
-    # consider only non-zero entries
-    probs_ = []
-    for p_ in probs:
-        if p_ > 0:
-            probs_.append(p_)
-    probs = probs_
-    n_traj = len(probs)
-    if n_traj < supp_traj:
-        print("Problem! n_traj < supp_traj , n_traj",n_traj,"supp_traj",supp_traj)
-    indexes = [i for i in range(len(probs))]
-    if debug_pval == 1:
-        print("indexes",indexes)
-        print("probs",probs)
-        print("supp_traj",supp_traj)
-    pval = 0.
-    probs_dyn = np.zeros((n_traj+1,n_traj+1))
-    probs_dyn[1,1] = probs_[0]
-    probs_dyn[1,0] = (1-probs_[0])
-    # fill the entire matrix
-    for i in range(2,n_traj+1):
-        for j in range(i+1):
-            pred_idx = j-1
-            if pred_idx >= 0:
-                pred_prob = probs_dyn[i-1 , pred_idx]
-            else:
-                pred_prob = 0.
-            probs_dyn[i,j] = probs_[i-1]*pred_prob + (1-probs_[i-1])*probs_dyn[i-1 , j]
-    for j in range(supp_traj,n_traj+1):
-        pval += probs_dyn[n_traj,j]
-    return pval
+    return compute_pvalues_fast([probs] , [supp_traj])[0]
 
 def compute_pvalue_exact(probs , supp_traj , debug_pval=0):
 
@@ -155,72 +279,170 @@ def compute_pvalue_exact(probs , supp_traj , debug_pval=0):
     return pval
 
 
+def refine_colors(colors , succ , pred):
+    """
+    Refine a node coloring until it is equitable: two nodes keep the same color only if they had the same color and the
+    same multisets of successor and predecessor colors. New colors are the ranks of these signatures, so isomorphic
+    colored graphs are refined to the same colors; the trace of all signatures tells whether two refinements agree.
+    """
+    trace = []
+    while True:
+        signatures = [(colors[v], tuple(sorted(colors[w] for w in succ[v])), tuple(sorted(colors[w] for w in pred[v])))
+                      for v in range(len(colors))]
+        ranks = {sig: i for i, sig in enumerate(sorted(set(signatures)))}
+        trace.append(tuple(sorted(signatures)))
+        refined = [ranks[sig] for sig in signatures]
+        if len(ranks) == len(set(colors)):
+            return refined, tuple(trace)
+        colors = refined
+
+def individualize(colors , v , succ , pred):
+    # give v a color of its own within its cell and refine
+    colors = [2*c for c in colors]
+    colors[v] += 1
+    return refine_colors(colors , succ , pred)
+
+def target_cell(colors):
+    # nodes of the first cell with more than one node
+    counts = dict()
+    for c in colors:
+        counts[c] = counts.get(c, 0) + 1
+    cell_color = min(c for c in counts if counts[c] > 1)
+    return [v for v in range(len(colors)) if colors[v] == cell_color]
+
+def is_automorphic(colors_a , colors_b , succ , pred , edges):
+    """
+    True if an automorphism of the graph maps the equitable coloring colors_a to colors_b, searched by individualizing
+    the first node of the first non-trivial cell of colors_a and every node of the same cell of colors_b.
+    """
+    if len(set(colors_a)) == len(colors_a):
+        node_of_color = {c: w for w, c in enumerate(colors_b)}
+        mapping = [node_of_color[c] for c in colors_a]
+        return all((mapping[u], mapping[v]) in edges for u, v in edges)
+    cell = target_cell(colors_a)
+    refined_a, trace_a = individualize(colors_a , cell[0] , succ , pred)
+    for w in [w for w in range(len(colors_b)) if colors_b[w] == colors_a[cell[0]]]:
+        refined_b, trace_b = individualize(colors_b , w , succ , pred)
+        if trace_a == trace_b and is_automorphic(refined_a , refined_b , succ , pred , edges):
+            return True
+    return False
+
+def count_color_automorphisms(colors , succ , pred , edges):
+    # size of the automorphism group fixing an equitable coloring: orbit of one node times the size of its stabilizer
+    if len(set(colors)) == len(colors):
+        return 1
+    cell = target_cell(colors)
+    fixed, trace = individualize(colors , cell[0] , succ , pred)
+    orbit = 1
+    for w in cell[1:]:
+        refined, trace_w = individualize(colors , w , succ , pred)
+        if trace == trace_w and is_automorphic(fixed , refined , succ , pred , edges):
+            orbit += 1
+    return orbit * count_color_automorphisms(fixed , succ , pred , edges)
+
+def twin_quotient(graph_):
+    """
+    Graph of the twin classes of a DAG, i.e. nodes with the same successors and predecessors: the nodes of each class,
+    the successor lists, predecessor lists and edges of the classes and their equitable coloring by root and class size.
+    """
+    classes = dict()
+    for node in graph_.nodes:
+        key = (frozenset(graph_.successors(node)), frozenset(graph_.predecessors(node)))
+        classes.setdefault(key, []).append(node)
+    class_lists = list(classes.values())
+    class_of = {node: i for i, nodes in enumerate(class_lists) for node in nodes}
+
+    edges = {(class_of[u], class_of[v]) for u, v in graph_.edges}
+    succ = [[] for _ in class_lists]
+    pred = [[] for _ in class_lists]
+    for u, v in edges:
+        succ[u].append(v)
+        pred[v].append(u)
+    # the root "0" gets a color of its own
+    initial = [("0" in nodes, len(nodes)) for nodes in class_lists]
+    ranks = {key: i for i, key in enumerate(sorted(set(initial)))}
+    colors, _ = refine_colors([ranks[key] for key in initial] , succ , pred)
+    return class_lists, succ, pred, edges, colors
+
 def compute_num_automorph(trajectory):
-    set_t_nodes_nogerm = set(trajectory.nodes)
-    # Sara: change "g" to "0"
-    set_t_nodes_nogerm.remove("0")
-    # compute number of automorphism of the trajectory
-    automorph = 0
-    trajectory_original = trajectory.copy()
-    trajectory_permuted = trajectory.copy()
-    set_t_nodes_nogerm_list = list(set_t_nodes_nogerm)
-    #print("set_t_nodes_nogerm_list",set_t_nodes_nogerm_list)
-    # Sara: this becomes too big for large trajectories; e.g. not feasible for 13 nodes
-    list_permutations = list(itertools.permutations(set_t_nodes_nogerm_list))
-    #print("list_permutations",list_permutations)
-    num_t_nodes = len(set_t_nodes_nogerm_list)
-    for permutation_ in list_permutations:
-        # create a mapping
-        map_p = dict()
-        for i in range(len(permutation_)):
-            map_p[set_t_nodes_nogerm_list[i]] = permutation_[i]
-        #print("map_p",map_p,"perm",permutation_)
-        trajectory_permuted = nx.relabel_nodes(trajectory_original, map_p)
-        if trajectory_permuted.edges == trajectory_original.edges:
-            automorph += 1
-            if automorph > 1:
-                #print("found ",automorph," automorphism!",map_p)
-                #print_graph(trajectory_original)
-                pass
-    return automorph
-
-def compute_prob(trajectory , graph_ , automorph_traj):
+    """
+    Number of permutations of the trajectory nodes other than the root "0" that keep its edges. Twins can be permuted
+    freely, they contribute the factorials of their class sizes. The automorphisms of the graph of twin classes, which
+    have to keep the class sizes, are counted by partition refinement and orbits as in nauty.
+    """
+    class_lists, succ, pred, edges, colors = twin_quotient(trajectory)
+    automorph = 1
+    for nodes in class_lists:
+        automorph *= math.factorial(len(nodes))
+    return automorph * count_color_automorphisms(colors , succ , pred , edges)
+
+def canonical_shape(graph_):
+    """
+    Canonical form of a DAG with root "0" up to the names of the other nodes, so two graphs have the same shape if and
+    only if they are isomorphic with the root kept. The form is the smallest encoding of the graph of twin classes over
+    the leaves of the refinement search, in which only the children with the smallest refinement trace are searched and
+    children mapped to an already searched child by an automorphism are skipped, as their leaves have the same forms.
+    """
+    class_lists, succ, pred, edges, colors = twin_quotient(graph_)
+    labels = [("0" in nodes, len(nodes)) for nodes in class_lists]
+    best = []
+
+    def search(colors):
+        if len(set(colors)) == len(colors):
+            order = sorted(range(len(colors)), key=colors.__getitem__)
+            form = (tuple(labels[v] for v in order), tuple(sorted((colors[u], colors[v]) for u, v in edges)))
+            if not best or form < best[0]:
+                best[:] = [form]
+            return
+        children = [individualize(colors , v , succ , pred) for v in target_cell(colors)]
+        min_trace = min(trace for _, trace in children)
+        searched = []
+        for refined, trace in children:
+            if trace != min_trace or any(is_automorphic(other , refined , succ , pred , edges) for other in searched):
+                continue
+            searched.append(refined)
+            search(refined)
+
+    search(colors)
+    return best[0]
+
+def load_shape_counts(path):
+    # add the counts stored by earlier runs, a missing or broken file is ignored
+    try:
+        with open(path, "rb") as f:
+            shape_counts.update(pickle.load(f))
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+def save_shape_counts(path):
+    # merged with the counts written by parallel runs in the meantime and written to a temporary file first
+    with FileLock(path+".lock"):
+        load_shape_counts(path)
+        with open(path+".tmp", "wb") as f:
+            pickle.dump(shape_counts, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path+".tmp", path)
+
+def count_by_shape(key , count):
+    # count() is only called if no trajectory or graph of the same shapes was counted before
+    if key not in shape_counts:
+        shape_counts[key] = count()
+        new_shape_counts[key] = shape_counts[key]
+    return shape_counts[key]
+
+def pop_new_shape_counts():
+    counts = dict(new_shape_counts)
+    new_shape_counts.clear()
+    return counts
+
+def compute_prob(trajectory , graph_ , automorph_traj , shapes=None):
     t = len(list(graph_.nodes))-1
     k = len(list(trajectory.nodes))-1
-    set_g_nodes_nogerm = set(graph_.nodes)
-    # Sara: change "g" to "0"
-    set_g_nodes_nogerm.remove("0")
-
-    # compute number of subsets of nodes of graph isomorphic to trajectory
-    subsets = findsubsets(set_g_nodes_nogerm, k)
-    num_isomorph = 0
-
-    debug_prob = 0
-    for u, v, label_ in graph_.edges(data="label"):
-        if label_ is not None:
-            #debug_prob = 1
-            debug_prob = 0
-    if debug_prob == 1:
-        print(graph_.edges(data="label"))
-        print_graph(graph_)
-        print_graph(trajectory)
-    if debug_prob == 1:
-        print("subsets",subsets)
-    for subset_g in subsets:
-        subset_g = list(subset_g)
-        # Sara: change "g" to "0"
-        subset_g.append("0")
-        sub_g = graph_.subgraph(subset_g).copy()
-        if nx.is_isomorphic(sub_g, trajectory):
-            num_isomorph += 1
-            if debug_prob == 1:
-                print("found iso!")
-        else:
-            if debug_prob == 1:
-                print("not iso...")
-        if debug_prob == 1:
-            #print_graph(trajectory)
-            print_graph(sub_g)
+
+    # compute number of subsets of nodes of graph isomorphic to trajectory, shared by inputs of the same shapes
+    if shapes is None:
+        num_isomorph = count_induced_subposets(trajectory , graph_)
+    else:
+        num_isomorph = count_by_shape(("embeddings",)+tuple(shapes) , lambda: count_induced_subposets(trajectory , graph_))
 
     prob_perm = num_isomorph*automorph_traj
     for i in range(k):
@@ -232,7 +454,7 @@ def compute_prob(trajectory , graph_ , automorph_traj):
     #print_graph(trajectory)
     return prob_indip , prob_perm
 
-def compute_statistics(probs , supp_traj , n):
+def compute_statistics(probs , supp_traj , n , pval=None):
     var_ = 0.
     avg_ = 0.
     freq_traj = 0.
@@ -250,7 +472,8 @@ def compute_statistics(probs , supp_traj , n):
     t_stat = freq_traj - avg_
     t_stat_norm = t_stat/math.sqrt(var_)
     pval_e = 0. #compute_pvalue_exact(probs , supp_traj)
-    pval = compute_pvalue_fast(probs , supp_traj)
+    if pval is None:
+        pval = compute_pvalue_fast(probs , supp_traj)
     if pval_e > 0. and abs(pval_e - pval) > pval_e/100:
         print("error in pvalue computation. pval_e",pval_e,"pval_f",pval)
         exit()
@@ -268,142 +491,270 @@ def compute_statistics(probs , supp_traj , n):
     return freq_traj , t_stat , t_stat_norm , avg_ , var_ , pval
 
 
-def run_stat_significancce_test(support_file: str, graph_file: str, output_file: str, cores: int, minp: str='', permutation_type: int=0):
-    verbose = 0
-    reading_ = True
-    seps = ["->-", "-/-", "-?-"]
-
-    # Updated by Sara
-    # out_dir will actually not be used if verbose is False
-    out_dir = output_file.replace('/significance_output.txt', '')
+def read_test_graphs(graph_file , out_dir , cores):
+    """
+    Input graphs of the test, their canonical shapes and their cohort, whose trees are in the order of the graphs and
+    whose inverted index answers the containment queries.
+    """
     graphs_dict = read_multiple_graphs_per_evolution(path=graph_file, out=out_dir,
                                                      parallel_processes=cores, verbose_flag=False)
     graphs_list = [graph for id in graphs_dict for graph in graphs_dict[id]]
+    return graphs_list, [canonical_shape(graph_) for graph_ in graphs_list], Cohort.from_graphs(graphs_dict)
 
+def get_test_graphs(cohort):
+    # same as read_test_graphs for a cohort that is already parsed
+    graphs_list = cohort.to_graphs()
+    return graphs_list, [canonical_shape(graph_) for graph_ in graphs_list], cohort
 
+def load_trajectories(support_file):
+    # (closed trajectory, reported support, names of supporting graphs) of each trajectory in the converted output
     # Sara added range and readlines here
     with open(support_file,"r") as file:
         fin_results = file.readlines()
-        trajectories_list = []
-        for i in range(0, len(fin_results), 2):
-            line = fin_results[i]
-            line = line.replace("\n","")
-            if "(" in line:
-                index_p = line.find("(")
-                line_edges_only = line[:index_p]
-                traj_rep_supp = line[index_p:]
-                traj_rep_supp = traj_rep_supp.replace("(","")
-                traj_rep_supp = int(traj_rep_supp.replace(")",""))
-                # Sara changed this to reported support from own support computation
-                next_line = fin_results[i+1].strip()
-                trans_ids = next_line.split(' ')
-                trajectory = load_graph(line_edges_only, '_'.join(trans_ids))
-                trajectories_list.append((trajectory, traj_rep_supp, trans_ids))
-
-        if verbose == 1:
-            print("loaded",len(trajectories_list),"trajectories")
+    rows = []
+    for i in range(0, len(fin_results), 2):
+        line = fin_results[i]
+        line = line.replace("\n","")
+        if "(" in line:
+            index_p = line.find("(")
+            line_edges_only = line[:index_p]
+            traj_rep_supp = line[index_p:]
+            traj_rep_supp = traj_rep_supp.replace("(","")
+            traj_rep_supp = int(traj_rep_supp.replace(")",""))
+            # Sara changed this to reported support from own support computation
+            next_line = fin_results[i+1].strip()
+            trans_ids = next_line.split(' ')
+            rows.append((line_edges_only, traj_rep_supp, trans_ids))
+    return build_trajectories(rows)
+
+def build_trajectories(rows):
+    # trajectories of converted rows (edges, reported support, names of supporting graphs)
+    return [(load_graph(edges, '_'.join(trans_ids)), traj_rep_supp, trans_ids) for edges, traj_rep_supp, trans_ids in rows]
+
+def trajectory_probs(trajectory , traj_shape , automorph_traj , graphs_list , graph_shapes , indices , ordered):
+    """
+    Probabilities of the trajectory in the input graphs of the given indices, which contain all its nodes. Graphs in
+    the bitset ordered get the orders of the trajectory first.
+    """
+    probs_ind = []
+    probs_perm = []
+    for index in indices:
+        # Modifications by Sara to account for new orders
+        if ordered >> index & 1:
+            ordered_graph = graphs_list[index].copy()
+            for edge in trajectory.edges:
+                if edge not in ordered_graph.edges:
+                    ordered_graph.add_edge(edge[0], edge[1])
+                    ordered_graph = nx.transitive_closure_dag(ordered_graph)
+            prob_graph_indip, prob_graph_perm = compute_prob(trajectory, ordered_graph, automorph_traj,
+                                                             (traj_shape, canonical_shape(ordered_graph)))
+        else:
+            prob_graph_indip , prob_graph_perm = compute_prob(trajectory, graphs_list[index], automorph_traj,
+                                                               (traj_shape, graph_shapes[index]))
+        probs_ind.append(prob_graph_indip)
+        probs_perm.append(prob_graph_perm)
+    return probs_ind , probs_perm
+
+def init_significance_worker(graphs_list , graph_shapes , cohort , permutation_type , counts):
+    # input graphs, their shapes and the cohort are sent once to each worker process
+    global worker_graphs, worker_shapes, worker_cohort, worker_permutation_type
+    worker_graphs, worker_shapes, worker_cohort, worker_permutation_type = graphs_list, graph_shapes, cohort, permutation_type
+    shape_counts.update(counts)
+
+def topology_probs(task):
+    # probabilities of a trajectory in a chunk of input graphs of distinct shapes, for the test over all trees
+    i , trajectory , indices = task
+    traj_shape = canonical_shape(trajectory)
+    automorph_traj = count_by_shape(("automorphisms", traj_shape) , lambda: compute_num_automorph(trajectory))
+    probs = {}
+    for index in indices:
+        probs[worker_shapes[index]] = compute_prob(trajectory , worker_graphs[index] , automorph_traj ,
+                                                   (traj_shape, worker_shapes[index]))[0]
+    return i , probs , pop_new_shape_counts()
+
+def add_topology_probs(trajectories_list , graph_shapes , permutation_type , map_function , chunks):
+    """
+    Append the probability of each trajectory in the test over all trees (None if permutation_type < 2), computed
+    once per graph shape in (trajectory, chunk of shapes) tasks of map_function and summed in input graph order.
+    """
+    if permutation_type < 2:
+        return [item + (None,) for item in trajectories_list]
+    representatives = {}
+    for index, shape in enumerate(graph_shapes):
+        representatives.setdefault(shape, index)
+    representatives = list(representatives.values())
+    size = max(1, -(-len(representatives) // chunks))
+    tasks = [(i, item[0], representatives[j:j+size]) for i, item in enumerate(trajectories_list)
+             for j in range(0, len(representatives), size)]
+
+    shape_probs = [{} for item in trajectories_list]
+    for i, probs, counts in map_function(topology_probs, tasks):
+        shape_probs[i].update(probs)
+        shape_counts.update(counts)
+    n = float(len(graph_shapes))
+    items = []
+    for item, probs in zip(trajectories_list, shape_probs):
+        prob_topologies = 0.
+        for shape in graph_shapes:
+            prob_topologies += probs[shape]/n
+        items.append(item + (prob_topologies,))
+    return items
+
+def test_trajectory(item):
+    """
+    Significance of one trajectory item of add_topology_probs against the graphs set by init_significance_worker.
+    Returns the output row, the p-value considered for the minimum and the counts computed for new shapes.
+    """
+    verbose = 0
+    (trajectory , supp_traj , trans_ids , prob_topologies) = item
+    trans_ids_allnodes = []
+    id_index_map = {}
+    for trans_id in iter_bits(worker_cohort.trees_containing(trajectory.nodes)):
+        # changes made by Sara
+        # trans_ids_allnodes.append(trans_id)
+        trans_ids_allnodes.append(worker_graphs[trans_id].name)
+        id_index_map[worker_graphs[trans_id].name] = trans_id
+    containing_edges = worker_cohort.supporting_trees(trajectory.nodes, trajectory.edges, exact=False)
+
+    if verbose == 1:
+        print(supp_traj,len(trans_ids_allnodes),trajectory.edges)
+    #print("  ",trans_ids_allnodes)
+    #print("  ",trans_ids)
+
+    traj_shape = canonical_shape(trajectory)
+    automorph_traj = count_by_shape(("automorphisms", traj_shape) , lambda: compute_num_automorph(trajectory))
+    # reported supporting graphs without the orders of the trajectory get them first
+    ordered = sum(1 << index for graph_id, index in id_index_map.items() if str(graph_id) in trans_ids)
+    probs_ind , probs_perm = trajectory_probs(trajectory , traj_shape , automorph_traj , worker_graphs , worker_shapes ,
+                                              [id_index_map[graph_id] for graph_id in trans_ids_allnodes] ,
+                                              ordered & ~containing_edges)
+    # third test: look at all trees
+    n = float(len(worker_graphs))
+    if worker_permutation_type >= 2:
+        probs_topologies = [prob_topologies for graph_id in trans_ids_allnodes]
+
+    # compute all pvalues, the tails of all tests in one batch
+    probs_tests = [probs_ind, probs_perm] + ([probs_topologies] if worker_permutation_type >= 2 else [])
+    pvals = compute_pvalues_fast(probs_tests , [supp_traj]*len(probs_tests))
+    freq_traj , t_stat_ind , t_stat_ind_norm , avg_ind , var_ind , pval_indip = compute_statistics(probs_ind , supp_traj , n , pvals[0])
+    freq_traj , t_stat_perm , t_stat_perm_norm , avg_perm , var_perm , pval_perm = compute_statistics(probs_perm , supp_traj , n , pvals[1])
+    if worker_permutation_type >= 2:
+        freq_traj , t_stat_topol , t_stat_topol_norm , avg_topol , var_topol , pval_topol = compute_statistics(probs_topologies , supp_traj , n , pvals[2])
+    #print(probs)
+    #print(np.array(probs).mean())
+
+    if verbose == 1:
+        print("obs freq",freq_traj, "exp" , avg_ind ,"var", var_ind ,"t-stat", t_stat_ind ,"t-stat-norm", t_stat_ind_norm,"pval", pval_indip )
+
+    min_pval_cand = pval_indip
+    if worker_permutation_type == 1:
+        min_pval_cand = pval_perm
+
+    str_to_output = "["
+    edge_id = 0
+    for edge in trajectory.edges:
+        if edge_id > 0:
+            str_to_output = str_to_output+","
+        str_to_output = str_to_output+str(edge[0])+"->-"+str(edge[1])
+        edge_id += 1
+    str_to_output = str_to_output+"];"
+    str_to_output = str_to_output+str(trans_ids)+";"
+    str_to_output = str_to_output+str(trans_ids_allnodes)+";"
+    str_to_output = str_to_output+str(supp_traj)+";"
+    str_to_output = str_to_output+str(freq_traj)+";"
+    # independent test
+    str_to_output = str_to_output+str(avg_ind)+";"
+    str_to_output = str_to_output+str(var_ind)+";"
+    str_to_output = str_to_output+str(t_stat_ind)+";"
+    str_to_output = str_to_output+str(t_stat_ind_norm)+";"
+    str_to_output = str_to_output+str(pval_indip)+";"
+    # permutation test
+    str_to_output = str_to_output+str(avg_perm)+";"
+    str_to_output = str_to_output+str(var_perm)+";"
+    str_to_output = str_to_output+str(t_stat_perm)+";"
+    str_to_output = str_to_output+str(t_stat_perm_norm)+";"
+    str_to_output = str_to_output+str(pval_perm)+";"
+    # non-fixed topologies test
+    if worker_permutation_type >= 2:
+        str_to_output = str_to_output+str(avg_topol)+";"
+        str_to_output = str_to_output+str(var_topol)+";"
+        str_to_output = str_to_output+str(t_stat_topol)+";"
+        str_to_output = str_to_output+str(t_stat_topol_norm)+";"
+        str_to_output = str_to_output+str(pval_topol)
+    str_to_output = str_to_output+"\n"
+    return str_to_output, min_pval_cand, pop_new_shape_counts()
+
+def run_stat_significancce_test(support_file: str, graph_file: str, output_file: str, cores: int, minp: str='', permutation_type: int=0,
+                                count_cache: str='', trajectories: list=None, cohort: Cohort=None):
+    """
+    Significance test of the trajectories in support_file against the input graphs in graph_file. The converted rows
+    of the trajectories (see convert_to_mastro_format.convert_rows) and the parsed cohort can be passed instead, then
+    neither file is read.
+    """
+    verbose = 0
+    reading_ = True
+    seps = ["->-", "-/-", "-?-"]
+
+    # Updated by Sara
+    # out_dir will actually not be used if verbose is False
+    out_dir = output_file.replace('/significance_output.txt', '')
+    if cohort is None:
+        graphs_list, graph_shapes, cohort = read_test_graphs(graph_file, out_dir, cores)
+    else:
+        graphs_list, graph_shapes, cohort = get_test_graphs(cohort)
+    # counts are cached by canonical shapes, optionally in a file reused by later runs
+    if count_cache:
+        load_shape_counts(count_cache)
+
+
+    if trajectories is None:
+        trajectories_list = load_trajectories(support_file)
+    else:
+        trajectories_list = build_trajectories(trajectories)
+    if verbose == 1:
+        print("loaded",len(trajectories_list),"trajectories")
 
     min_pval = 1.
     fout_ = open(output_file,"w")
     fout_.write("edges_traj;traj_occ_list;traj_alt_occ_list;traj_supp;traj_freq;traj_exp_ind;traj_var_ind;t_stat_ind;t_stat_norm_ind;pval_ind;traj_exp_perm;traj_var_perm;t_stat_perm;t_stat_norm_perm;pval_perm;traj_exp_topol;traj_var_topol;t_stat_topol;t_stat_norm_topol;pval_topol\n")
-    for (trajectory , supp_traj , trans_ids) in trajectories_list:
-        trans_id = 0
-        trans_ids_allnodes = []
-        id_index_map = {}
-        for graph_ in graphs_list:
-            if set(trajectory.nodes).issubset(set(graph_.nodes)):
-                # changes made by Sara
-                # trans_ids_allnodes.append(trans_id)
-                trans_ids_allnodes.append(graph_.name)
-                id_index_map[graph_.name] = trans_id
-            trans_id += 1
-
-        if verbose == 1:
-            print(supp_traj,len(trans_ids_allnodes),trajectory.edges)
-        #print("  ",trans_ids_allnodes)
-        #print("  ",trans_ids)
-
-        probs_ind = []
-        probs_perm = []
-        automorph_traj = compute_num_automorph(trajectory)
-        for graph_id in trans_ids_allnodes:
-            # Modifications by Sara to account for new orders
-            index = id_index_map[graph_id]
-            if str(graph_id) in trans_ids and (not set(trajectory.edges).issubset(set(graphs_list[index].edges))):
-                ordered_graph = graphs_list[index].copy()
-                for edge in trajectory.edges:
-                    if edge not in ordered_graph.edges:
-                        ordered_graph.add_edge(edge[0], edge[1])
-                        ordered_graph = nx.transitive_closure_dag(ordered_graph)
-                prob_graph_indip, prob_graph_perm = compute_prob(trajectory, ordered_graph, automorph_traj)
-                print(prob_graph_indip, prob_graph_perm)
-            else:
-                prob_graph_indip , prob_graph_perm = compute_prob(trajectory, graphs_list[index], automorph_traj)
-            probs_ind.append(prob_graph_indip)
-            probs_perm.append(prob_graph_perm)
-        # third test: look at all trees
-        n = float(len(graphs_list))
-        if permutation_type >= 2:
-            prob_topologies = 0.
-            for graph_ in graphs_list:
-                prob_graph_indip , prob_graph_perm = compute_prob(trajectory , graph_ , automorph_traj)
-                prob_topologies += prob_graph_indip/n
-                #print("prob_graph_indip",prob_graph_indip)
-            probs_topologies = [prob_topologies for graph_id in trans_ids_allnodes]
-
-        # compute all pvalues
-        freq_traj , t_stat_ind , t_stat_ind_norm , avg_ind , var_ind , pval_indip = compute_statistics(probs_ind , supp_traj , n)
-        freq_traj , t_stat_perm , t_stat_perm_norm , avg_perm , var_perm , pval_perm = compute_statistics(probs_perm , supp_traj , n)
+    # trajectories are tested in parallel, rows are written in input order as soon as all earlier rows are done
+    init_args = (graphs_list, graph_shapes, cohort, permutation_type, shape_counts)
+    # the test over all trees is split into (trajectory, chunk of graph shapes) tasks first
+    # the workers are terminated if a worker or the loop over the results fails
+    pool = None
+    try:
+        start = time.perf_counter()
+        if cores > 1 and (len(trajectories_list) > 1 or permutation_type >= 2):
+            pool = Pool(cores, initializer=init_significance_worker, initargs=init_args)
+            items = add_topology_probs(trajectories_list, graph_shapes, permutation_type, pool.imap, 4 * cores)
+            results = pool.imap(test_trajectory, items)
+        else:
+            init_significance_worker(*init_args)
+            items = add_topology_probs(trajectories_list, graph_shapes, permutation_type, map, 1)
+            results = map(test_trajectory, items)
         if permutation_type >= 2:
-            freq_traj , t_stat_topol , t_stat_topol_norm , avg_topol , var_topol , pval_topol = compute_statistics(probs_topologies , supp_traj , n)
-        #print(probs)
-        #print(np.array(probs).mean())
+            print(f"Significance test: all trees test of {len(trajectories_list)} trajectories, {time.perf_counter() - start:.1f}s")
 
-        if verbose == 1:
-            print("obs freq",freq_traj, "exp" , avg_ind ,"var", var_ind ,"t-stat", t_stat_ind ,"t-stat-norm", t_stat_ind_norm,"pval", pval_indip )
-
-        min_pval_cand = pval_indip
-        if permutation_type == 1:
-            min_pval_cand = pval_perm
-        if min_pval_cand < min_pval:
+        last_report = start
+        for i, (str_to_output, min_pval_cand, counts) in enumerate(results, 1):
+            fout_.write(str_to_output)
+            fout_.flush()
+            shape_counts.update(counts)
             min_pval = min(min_pval,min_pval_cand)
-            min_traj = (trajectory , supp_traj , trans_ids)
-
-        str_to_output = "["
-        edge_id = 0
-        for edge in trajectory.edges:
-            if edge_id > 0:
-                str_to_output = str_to_output+","
-            str_to_output = str_to_output+str(edge[0])+"->-"+str(edge[1])
-            edge_id += 1
-        str_to_output = str_to_output+"];"
-        str_to_output = str_to_output+str(trans_ids)+";"
-        str_to_output = str_to_output+str(trans_ids_allnodes)+";"
-        str_to_output = str_to_output+str(supp_traj)+";"
-        str_to_output = str_to_output+str(freq_traj)+";"
-        # independent test
-        str_to_output = str_to_output+str(avg_ind)+";"
-        str_to_output = str_to_output+str(var_ind)+";"
-        str_to_output = str_to_output+str(t_stat_ind)+";"
-        str_to_output = str_to_output+str(t_stat_ind_norm)+";"
-        str_to_output = str_to_output+str(pval_indip)+";"
-        # permutation test
-        str_to_output = str_to_output+str(avg_perm)+";"
-        str_to_output = str_to_output+str(var_perm)+";"
-        str_to_output = str_to_output+str(t_stat_perm)+";"
-        str_to_output = str_to_output+str(t_stat_perm_norm)+";"
-        str_to_output = str_to_output+str(pval_perm)+";"
-        # non-fixed topologies test
-        if permutation_type >= 2:
-            str_to_output = str_to_output+str(avg_topol)+";"
-            str_to_output = str_to_output+str(var_topol)+";"
-            str_to_output = str_to_output+str(t_stat_topol)+";"
-            str_to_output = str_to_output+str(t_stat_topol_norm)+";"
-            str_to_output = str_to_output+str(pval_topol)
-        str_to_output = str_to_output+"\n"
-        fout_.write(str_to_output)
-
-    fout_.close()
+            now = time.perf_counter()
+            if now - last_report >= 10 or i == len(trajectories_list):
+                last_report = now
+                eta = (now - start) / i * (len(trajectories_list) - i)
+                print(f"Significance test: {i}/{len(trajectories_list)} trajectories, {now - start:.1f}s elapsed, ETA {eta:.1f}s")
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        fout_.close()
+    if count_cache and os.path.isdir(os.path.dirname(count_cache)):
+        save_shape_counts(count_cache)
 
     print("min pvalue",min_pval)
     # print(min_traj[0].edges,min_traj[1],min_traj[2])
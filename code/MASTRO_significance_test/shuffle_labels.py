@@ -1,61 +1,147 @@
-import random
-import re
-
-
-def shuffle_da_list(a_list, zero=True):
-    mutations_copy = a_list.copy()
-    random.shuffle(mutations_copy)
-
-    if zero:
-        mutations_copy = ['0'] + mutations_copy
-    print(mutations_copy)
-    return mutations_copy
-
-
-def replace_match(match):
-    return replacements[match.group(0)]
-
-
-graph_ids = '47 72\n'
-graph = '0->-DNMT3A NPM1->-FLT3 NPM1->-NRAS DNMT3A->-NPM1'
-graph_split = graph.split(' ')
-mutations = set()
-for edge in graph_split:
-    if '-?-' in edge:
-        a, b = edge.split('-?-')
-        mutations.add(a)
-        mutations.add(b)
-    if '->-' in edge:
-        a, b = edge.split('->-')
-        mutations.add(a)
-        mutations.add(b)
-
-mutations = list(mutations)
-if '0' in mutations:
-    mutations.remove('0')
-
-replaced_strings = []
-for i in range(10):
-    add_zero = ('0' in mutations)
-    shuffled_list = shuffle_da_list(mutations, add_zero)
-    tmp = zip(mutations, shuffled_list)
-    replacements = dict(tmp)
-
-    pattern = re.compile("|".join(re.escape(k) for k in replacements.keys()))
-
-    result = pattern.sub(replace_match, graph)
-    replaced_strings.append(result)
-
-with open('test_graphs.txt', 'w') as file:
-    file.write(graph + ' (2)\n')
-    file.write(graph_ids)
-    for entry in replaced_strings:
-        file.write(entry + ' (2)\n')
-        file.write(graph_ids)
-
-
-
-
-
-
-
+import argparse
+import time
+import numpy as np
+from multiprocessing import Pool
+from cohort import Cohort, iter_bits
+from MASTRO_significance_test.compute_significance import read_test_graphs, load_trajectories, canonical_shape, \
+    compute_num_automorph, compute_pvalues_fast, count_by_shape, trajectory_probs, init_significance_worker, \
+    add_topology_probs, test_trajectory
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Permutation test of the minimum p-value of trajectories: the '
+                                                 'mutations of each input graph are shuffled among themselves')
+    parser.add_argument('--dags', '-d', required=True, dest='dags', type=str,
+                        help='Input DAGs the trajectories were computed from')
+    parser.add_argument('--input', '-i', required=True, dest='input', type=str,
+                        help='Trajectories in the converted format, e.g. converted_graphs.txt of POTTR')
+    parser.add_argument('--permutations', '-n', default=1000, dest='permutations', type=int,
+                        help='Number of label permutations of the input DAGs')
+    parser.add_argument('--seed', '-s', default=0, dest='seed', type=int,
+                        help='Seed of the permutations')
+    parser.add_argument('--cores', '-c', default=1, dest='cores', type=int,
+                        help='Number of processes the permutations are distributed over')
+    parser.add_argument('--permutation-type', '-pt', default=0, dest='permutation_type', type=int,
+                        help='Test of the minimum p-value as in run_stat_significancce_test, 1 for the permutation test')
+    parser.add_argument('--resolution_threshold', '-rt', default=1, dest='resolution_threshold', type=int,
+                        help='Resolution threshold of hidden orders the trajectories were computed with, see run_POTTR')
+    parser.add_argument('--resolution_frequency', '-rf', action='store_true',
+                        help='Resolve hidden orders only to the most frequent order as the trajectories, see run_POTTR')
+    parser.add_argument('--output', '-o', dest='output', type=str,
+                        help='Optional file to write the minimum p-value of each permutation to')
+    return parser
+
+
+def get_trajectory_tests(trajectories_list: list, graphs_list: list, graph_shapes: list, cohort: Cohort):
+    """
+    Trajectory, its shape and automorphisms, the reported supporting graphs, the graphs containing its nodes (the last
+    one of each name, as in test_trajectory) and their probabilities of each trajectory. Shuffling the labels of a
+    graph keeps its mutations and topology, so only the probabilities of graphs that get the orders of the trajectory
+    change between permutations.
+    """
+    tests = []
+    for trajectory, _, trans_ids in trajectories_list:
+        traj_shape = canonical_shape(trajectory)
+        automorph_traj = count_by_shape(("automorphisms", traj_shape), lambda: compute_num_automorph(trajectory))
+        id_index_map = {cohort.tree_names[t]: t for t in iter_bits(cohort.trees_containing(trajectory.nodes))}
+        indices = [id_index_map[cohort.tree_names[t]] for t in iter_bits(cohort.trees_containing(trajectory.nodes))]
+        selected = sum(1 << t for t in range(len(cohort)) if str(cohort.tree_names[t]) in trans_ids)
+        probs = trajectory_probs(trajectory, traj_shape, automorph_traj, graphs_list, graph_shapes, indices, 0)
+        tests.append((trajectory, traj_shape, automorph_traj, selected, id_index_map, indices, probs))
+    return tests
+
+
+def init_permutation_worker(graphs_list: list, graph_shapes: list, cohort: Cohort, tests: list, seed: int,
+                            permutation_type: int, resolution: tuple):
+    # the input graphs, the parsed cohort and the probabilities are sent once to each worker process
+    global worker_graphs, worker_shapes, worker_cohort, worker_tests, worker_seed, worker_permutation_type, \
+        worker_resolution
+    worker_graphs, worker_shapes, worker_cohort, worker_tests = graphs_list, graph_shapes, cohort, tests
+    worker_seed, worker_permutation_type, worker_resolution = seed, permutation_type, resolution
+
+
+def min_pvalue(cohort: Cohort):
+    """
+    Minimum p-value of the trajectories in a cohort with the same relabelled trees as the input graphs, with supports
+    and probabilities as in compute_support and test_trajectory. The graphs selected by the ILP are not known for a
+    permutation, so the reported supporting graphs stand for them as long as they still support the trajectory by
+    resolving hidden orders (see Cohort.resolvable_orders); exact matches are added as in compute_support.
+    """
+    resolvable = cohort.resolvable_orders(*worker_resolution)
+    probs_list, supports = [], []
+    for trajectory, traj_shape, automorph_traj, selected, id_index_map, indices, probs in worker_tests:
+        supporting = cohort.supporting_trees(trajectory.nodes, trajectory.edges)
+        supporting |= selected & cohort.supporting_trees(trajectory.nodes, trajectory.edges, resolve=True,
+                                                         resolvable=resolvable)
+        names = {cohort.tree_names[t] for t in iter_bits(supporting)}
+        ordered = sum(1 << index for name, index in id_index_map.items() if name in names)
+        ordered &= ~cohort.supporting_trees(trajectory.nodes, trajectory.edges, exact=False)
+        if ordered:
+            graphs_list = list(worker_graphs)
+            for t in iter_bits(ordered):
+                graphs_list[t] = cohort.to_graph(t)
+            probs = trajectory_probs(trajectory, traj_shape, automorph_traj, graphs_list, worker_shapes, indices,
+                                     ordered)
+        probs_list.append(probs[1] if worker_permutation_type == 1 else probs[0])
+        supports.append(len(names))
+    return min(compute_pvalues_fast(probs_list, supports) + [1.])
+
+
+def permutation_min_pvalue(index: int):
+    # each permutation has its own random generator, so the result does not depend on the distribution over workers
+    return min_pvalue(worker_cohort.shuffle_labels(np.random.default_rng([worker_seed, index])))
+
+
+def observed_min_pvalue(trajectories_list: list, graphs_list: list, graph_shapes: list, cohort: Cohort,
+                        permutation_type: int):
+    # minimum p-value of the significance test with the reported supports
+    init_significance_worker(graphs_list, graph_shapes, cohort, permutation_type, {})
+    items = add_topology_probs(trajectories_list, graph_shapes, permutation_type, map, 1)
+    return min([test_trajectory(item)[1] for item in items] + [1.])
+
+
+def permutation_test(trajectories_list: list, graphs_list: list, graph_shapes: list, cohort: Cohort,
+                     num_permutations: int, seed: int=0, cores: int=1, permutation_type: int=0,
+                     resolution_threshold: int=1, resolution_frequency: bool=False):
+    """
+    Empirical null distribution of the minimum p-value over all trajectories: the labels of each input graph are
+    shuffled in memory and the supports and p-values of the trajectories are recomputed for each permutation (see
+    min_pvalue). Returns the minimum p-value of each permutation in the order of the permutations. Without shuffling,
+    the minimum p-value has to be the one of the significance test, otherwise a ValueError is raised.
+    """
+    tests = get_trajectory_tests(trajectories_list, graphs_list, graph_shapes, cohort)
+    resolution = (resolution_threshold, resolution_frequency)
+    init_args = (graphs_list, graph_shapes, cohort, tests, seed, permutation_type, resolution)
+
+    init_permutation_worker(*init_args)
+    identity = min_pvalue(cohort)
+    observed = observed_min_pvalue(trajectories_list, graphs_list, graph_shapes, cohort, permutation_type)
+    print('Minimum p-value of the trajectories', observed, 'without shuffling', identity)
+    if not np.isclose(identity, observed, rtol=1e-9, atol=0.):
+        raise ValueError(f'Minimum p-value {identity} without shuffling differs from the observed minimum p-value '
+                         f'{observed}, are the reported supports computed from the same input DAGs and resolution?')
+
+    start = time.perf_counter()
+    if cores > 1 and num_permutations > 1:
+        with Pool(cores, initializer=init_permutation_worker, initargs=init_args) as pool:
+            null = pool.map(permutation_min_pvalue, range(num_permutations),
+                            chunksize=max(1, num_permutations // (4 * cores)))
+    else:
+        null = [permutation_min_pvalue(i) for i in range(num_permutations)]
+    print(f'{num_permutations} permutations in {time.perf_counter() - start:.1f}s')
+    return np.array(null)
+
+
+def main():
+    args = get_parser().parse_args()
+    graphs_list, graph_shapes, cohort = read_test_graphs(args.dags, '', args.cores)
+    trajectories_list = load_trajectories(args.input)
+    null = permutation_test(trajectories_list, graphs_list, graph_shapes, cohort, args.permutations, args.seed,
+                            args.cores, args.permutation_type, args.resolution_threshold, args.resolution_frequency)
+    print('5% quantile of the minimum p-value', np.quantile(null, 0.05))
+    if args.output:
+        np.savetxt(args.output, null)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,90 +1,442 @@
 # ---------------------------------------------------------------------------- #
 #                                    IMPORTS                                   #
 # ---------------------------------------------------------------------------- #
-import networkx as nx
-import gurobipy as gp
-from gurobipy import GRB
+from __future__ import annotations
+import time
+import resource
+import numpy as np
+import scipy.sparse as sp
+from cohort import Cohort
+from conflict_store import ConflictStore
+
+# gurobipy is optional, without it only the HiGHS backend in solver_highs can be used
+try:
+    import gurobipy as gp
+    from gurobipy import GRB
+except ImportError:
+    gp = None
 
 # ---------------------------------------------------------------------------- #
 #                                   FUNCTIONS                                  #
 # ---------------------------------------------------------------------------- #
 
 
-def find_max_k_common_trajectory(union_conflict_graph: nx.MultiGraph, input_graphs: dict, k: int, cores: int, solution_pool_size: int=5000, verbose: bool=False):
-    m = gp.Model('POTTR')
-    if cores > 0:
-        m.setParam('Threads', cores)
-    m.setParam('OutputFlag', verbose)
-    m.setParam('Seed', 42)
+def get_presence_matrix(conflicts: ConflictStore, cohort: Cohort):
+    # boolean matrix of the nodes of the conflict graph (rows) occurring in each tree (columns)
+    presence = np.zeros((len(conflicts.nodes), len(cohort)), dtype=bool)
+    for t in range(len(cohort)):
+        presence[:, t] = np.isin(conflicts.nodes, cohort.nodes(t))
+    return presence
 
-    if solution_pool_size > 0:
-        m.setParam('PoolSearchMode', 2)  # Search for alternative optimal solutions
-        m.setParam('PoolGap', 0.00001)
-        m.setParam('PoolSolutions', solution_pool_size)
 
+def incidence_matrix(rows: int, columns: int, *column_indices):
+    # sparse 0/1 matrix with a one in each row at every given column index
+    row_indices = np.tile(np.arange(rows), len(column_indices))
+    data = np.ones(len(row_indices))
+    return sp.csr_matrix((data, (row_indices, np.concatenate(column_indices))), shape=(rows, columns))
+
+
+def build_model_loop(m: gp.Model, conflicts: ConflictStore, cohort: Cohort, k: int):
     # define variables
+    mutations = conflicts.mutations
     nodes = gp.tupledict()
-    for n in union_conflict_graph.nodes:
-        nodes[n] = m.addVar(vtype=GRB.BINARY, name=n)
-
-    edges = gp.tupledict()
-    for e in union_conflict_graph.edges:
-        a, b, _ = e
-        edge_name = a + '->-' + b + ';' + union_conflict_graph.edges[e]['label']
-        edges[edge_name] = m.addVar(vtype=GRB.BINARY, name=edge_name)
-
-    graphs = dict()
-    for patient in input_graphs:
-        graphs[patient] = gp.tupledict()
-        for g in input_graphs[patient]:
-            name = g.name
-            graphs[patient][name] = m.addVar(vtype=GRB.BINARY, name=name)
+    for v in conflicts.nodes.tolist():
+        nodes[v] = m.addVar(vtype=GRB.BINARY, name=mutations[v])
+
+    graphs = gp.tupledict()
+    for t, name in enumerate(cohort.tree_names):
+        graphs[t] = m.addVar(vtype=GRB.BINARY, name=name)
 
     # set constraints
     m.setObjective(gp.quicksum(nodes), GRB.MAXIMIZE)
 
-    for edge in edges:
-        node_names, graph_names = edge.split(';')
+    for a, b, t1, t2 in zip(*conflicts.conflicts()):
+        a, b, t1, t2 = int(a), int(b), int(t1), int(t2)
+        g1, g2 = cohort.tree_names[t1], cohort.tree_names[t2]
+        edge_name = mutations[a] + '->-' + mutations[b] + ';' + g1 + ':' + g2
+        edge = m.addVar(vtype=GRB.BINARY, name=edge_name)
         # if both graphs of a conflict edge are selected, edge must be active
-        g1, g2 = graph_names.split(':')
-        p1, _ = g1.split('-')
-        p2, _ = g2.split('-')
-        m.addConstr(edges[edge] >= graphs[p1][g1] + graphs[p2][g2] - 1,
-                    'Activate edge ' + edge + ' for graphs ' + g1 + ' ' + g2)
+        m.addConstr(edge >= graphs[t1] + graphs[t2] - 1, 'Activate edge ' + edge_name + ' for graphs ' + g1 + ' ' + g2)
         # independent set constraint
-        a, b = node_names.split('->-')
-        m.addConstr(nodes[a] + nodes[b] <= 2 - edges[edge], 'Forbidden to include both nodes ' + a + ' ' + b)
+        m.addConstr(nodes[a] + nodes[b] <= 2 - edge, 'Forbidden to include both nodes ' + mutations[a] + ' ' + mutations[b])
 
-    for patient in input_graphs:
+    for trees in cohort.patient_trees:
         # in case of multiple graphs per patient, we ensure that at most one can be selected per patient
-        m.addConstr(gp.quicksum(graphs[patient]) <= 1, 'Select at most one graph per patient')
+        m.addConstr(gp.quicksum(graphs[t] for t in trees) <= 1, 'Select at most one graph per patient')
 
-        for g in input_graphs[patient]:
+        for t in trees:
             # add constraint that selected node must occur in all selected graphs
-            for node in union_conflict_graph.nodes:
-                constant = int(node in g.nodes)
-                m.addConstr(nodes[node] <= constant + (1 - graphs[patient][g.name]),
-                            'Selected nodes must occur in all selected graphs')
-    
-    m.addConstr(sum([gp.quicksum(graphs[patient]) for patient in input_graphs]) >= k, 'Select k ' + str(k) + ' graphs')
+            for v in nodes:
+                constant = cohort.tree_nodes[t] >> v & 1
+                m.addConstr(nodes[v] <= constant + (1 - graphs[t]), 'Selected nodes must occur in all selected graphs')
 
-    m.optimize()
+    # a graph of a deduplicated cohort counts for all patients it stands for
+    k_constraint = m.addConstr(gp.quicksum(cohort.tree_weights[t] * graphs[t] for t in graphs) >= k,
+                               'Select k ' + str(k) + ' graphs')
+
+    return gp.MVar.fromlist(list(nodes.values())), gp.MVar.fromlist(list(graphs.values())), k_constraint
+
+
+def build_model_matrix(m: gp.Model, conflicts: ConflictStore, cohort: Cohort, k: int, names: bool=False):
+    """
+    Same model as build_model_loop, built with the matrix API over the integer conflict arrays. Names are only set
+    with names=True.
+    """
+    mutations = conflicts.mutations
+    num_nodes, num_trees = len(conflicts.nodes), len(cohort)
+    a, b, t1, t2 = conflicts.conflicts()
+    a, b = np.searchsorted(conflicts.nodes, a), np.searchsorted(conflicts.nodes, b)
+
+    # define variables
+    x = m.addMVar(num_nodes, vtype=GRB.BINARY, name=[mutations[v] for v in conflicts.nodes] if names else '')
+    y = m.addMVar(num_trees, vtype=GRB.BINARY, name=cohort.tree_names if names else '')
+    edge_names = ''
+    if names:
+        edge_names = [mutations[conflicts.nodes[i]] + '->-' + mutations[conflicts.nodes[j]] + ';' +
+                      cohort.tree_names[g1] + ':' + cohort.tree_names[g2] for i, j, g1, g2 in zip(a, b, t1, t2)]
+    e = m.addMVar(len(a), vtype=GRB.BINARY, name=edge_names)
+
+    # set constraints
+    m.setObjective(x.sum(), GRB.MAXIMIZE)
+
+    # if both graphs of a conflict edge are selected, edge must be active
+    m.addConstr(incidence_matrix(len(a), num_trees, t1, t2) @ y - e <= 1, name='activate' if names else '')
+    # independent set constraint
+    m.addConstr(incidence_matrix(len(a), num_nodes, a, b) @ x + e <= 2, name='independent' if names else '')
+
+    # in case of multiple graphs per patient, we ensure that at most one can be selected per patient
+    patient_matrix = incidence_matrix(num_trees, len(cohort.patients), cohort.tree_patient).T.tocsr()
+    m.addConstr(patient_matrix @ y <= 1, name='patient' if names else '')
+
+    # selected nodes must occur in all selected graphs
+    absent_nodes, absent_trees = np.nonzero(~get_presence_matrix(conflicts, cohort))
+    m.addConstr(incidence_matrix(len(absent_nodes), num_nodes, absent_nodes) @ x +
+                incidence_matrix(len(absent_nodes), num_trees, absent_trees) @ y <= 1, name='presence' if names else '')
+
+    k_constraint = m.addConstr(np.asarray(cohort.tree_weights, dtype=float) @ y >= k, name='k' if names else '')
+
+    return x, y, k_constraint
+
+
+def presolve(conflicts: ConflictStore, cohort: Cohort, k: int, drop_trees: bool=True):
+    """
+    Drop nodes of fewer than k patients and, with drop_trees, graphs without viable nodes until nothing changes.
+    Returns the masks of kept nodes, kept graphs and conflicts between them.
+    """
+    presence = get_presence_matrix(conflicts, cohort)
+    patient_matrix = incidence_matrix(len(cohort), len(cohort.patients), cohort.tree_patient)
+    patient_weights = np.asarray(cohort.patient_weights(), dtype=np.int64)
+    tree_patient = np.asarray(cohort.tree_patient)
+    non_root = conflicts.nodes != 0
+    node_mask = np.ones(len(conflicts.nodes), dtype=bool)
+    tree_mask = np.ones(len(cohort), dtype=bool)
+    while True:
+        patients_per_node = ((presence & tree_mask).astype(np.int64) @ patient_matrix > 0) @ patient_weights
+        viable_nodes = node_mask & (patients_per_node >= k)
+        viable_trees = tree_mask & presence[viable_nodes & non_root].any(axis=0)
+        if not drop_trees or patient_weights[np.unique(tree_patient[viable_trees])].sum() < k:
+            viable_trees = tree_mask
+        if np.array_equal(viable_nodes, node_mask) and np.array_equal(viable_trees, tree_mask):
+            break
+        node_mask, tree_mask = viable_nodes, viable_trees
+
+    a, b, t1, t2 = conflicts.conflicts()
+    kept_nodes = np.isin(a, conflicts.nodes[node_mask]) & np.isin(b, conflicts.nodes[node_mask])
+    conflict_mask = kept_nodes & tree_mask[t1] & tree_mask[t2]
+    return node_mask, tree_mask, conflict_mask
+
+
+def get_model_arrays(conflicts: ConflictStore, cohort: Cohort, k: int, drop_trees: bool=True, presolve_model: bool=True):
+    """
+    Solver independent model of the presolved instance over x (nodes), y (graphs) and w (shared graph pair variables).
+    Returns the node ids, graph indices, number of w and the constraints (name, matrix, rhs) except sum(y) >= k.
+    """
+    num_nodes, num_trees = len(conflicts.nodes), len(cohort)
+    num_conflicts = len(conflicts)
+    if presolve_model:
+        node_mask, tree_mask, conflict_mask = presolve(conflicts, cohort, k, drop_trees)
+    else:
+        node_mask, tree_mask = np.ones(num_nodes, dtype=bool), np.ones(num_trees, dtype=bool)
+        conflict_mask = np.ones(num_conflicts, dtype=bool)
+    node_ids, tree_ids = conflicts.nodes[node_mask], np.flatnonzero(tree_mask)
+
+    # positions of the kept nodes and graphs in the model variables
+    pairs, tree_pairs = conflicts.pairs[conflict_mask], conflicts.tree_pairs[conflict_mask]
+    a, b = conflicts.decode_pairs(pairs)
+    t1, t2 = conflicts.decode_tree_pairs(tree_pairs)
+    a, b = np.searchsorted(node_ids, a), np.searchsorted(node_ids, b)
+    t1, t2 = np.searchsorted(tree_ids, t1), np.searchsorted(tree_ids, t2)
+
+    # group the node pairs by their set of conflicting graph pairs, conflicts are sorted by node pair and graph pair
+    pair_starts = np.flatnonzero(np.r_[True, pairs[1:] != pairs[:-1]]) if len(pairs) else np.zeros(0, dtype=np.int64)
+    pair_ends = np.r_[pair_starts[1:], len(pairs)]
+    groups = dict()
+    for s, e in zip(pair_starts, pair_ends):
+        groups.setdefault(tree_pairs[s:e].tobytes(), []).append(s)
+    shared = np.zeros(len(pairs), dtype=bool)
+    shared_starts, shared_ends, shared_pairs = [], [], []
+    for members in groups.values():
+        s = members[0]
+        e = pair_ends[np.searchsorted(pair_starts, s)]
+        if len(members) > 1 and e - s > 1:
+            for member in members:
+                shared[member:pair_ends[np.searchsorted(pair_starts, member)]] = True
+            shared_starts.append(s)
+            shared_ends.append(e)
+            shared_pairs.append(members)
+    num_shared = len(shared_pairs)
+
+    def block(rows, node_columns=(), tree_columns=(), shared_columns=(), shared_sign=1):
+        # constraint rows over the variables x, y, w given by the columns of their ones
+        return sp.hstack([incidence_matrix(rows, len(node_ids), *node_columns) if node_columns
+                          else sp.csr_matrix((rows, len(node_ids))),
+                          incidence_matrix(rows, len(tree_ids), *tree_columns) if tree_columns
+                          else sp.csr_matrix((rows, len(tree_ids))),
+                          shared_sign * incidence_matrix(rows, num_shared, *shared_columns) if shared_columns
+                          else sp.csr_matrix((rows, num_shared))], format='csr')
+
+    constraints = []
+    # conflicts that are not shared with other node pairs
+    direct = ~shared
+    constraints.append(('conflict', block(direct.sum(), (a[direct], b[direct]), (t1[direct], t2[direct])), 3))
+
+    # shared sets of conflicting graph pairs
+    group_rows = np.concatenate([np.full(e - s, i) for i, (s, e) in enumerate(zip(shared_starts, shared_ends))] +
+                                [np.zeros(0, dtype=np.int64)])
+    group_conflicts = np.concatenate([np.arange(s, e) for s, e in zip(shared_starts, shared_ends)] +
+                                     [np.zeros(0, dtype=np.int64)])
+    constraints.append(('activate', block(len(group_rows), (), (t1[group_conflicts], t2[group_conflicts]),
+                                          (group_rows,), -1), 1))
+    member_rows = np.concatenate([np.full(len(members), i) for i, members in enumerate(shared_pairs)] +
+                                 [np.zeros(0, dtype=np.int64)])
+    member_starts = np.concatenate([members for members in shared_pairs] + [np.zeros(0, dtype=np.int64)])
+    constraints.append(('independent', block(len(member_rows), (a[member_starts], b[member_starts]), (),
+                                             (member_rows,)), 2))
+
+    # in case of multiple graphs per patient, we ensure that at most one can be selected per patient
+    tree_patient = np.asarray(cohort.tree_patient)[tree_ids]
+    patient_matrix = incidence_matrix(len(tree_ids), len(cohort.patients), tree_patient).T.tocsr()
+    constraints.append(('patient', sp.hstack([sp.csr_matrix((len(cohort.patients), len(node_ids))), patient_matrix,
+                                              sp.csr_matrix((len(cohort.patients), num_shared))], format='csr'), 1))
+
+    # selected nodes must occur in all selected graphs
+    full_presence = get_presence_matrix(conflicts, cohort)
+    absent_nodes, absent_trees = np.nonzero(~full_presence[np.ix_(node_mask, tree_mask)])
+    constraints.append(('presence', block(len(absent_nodes), (absent_nodes,), (absent_trees,)), 1))
 
+    num_variables = len(node_ids) + len(tree_ids) + num_shared
+    num_constraints = sum(matrix.shape[0] for _, matrix, _ in constraints) + 1
+    full_constraints = 2 * num_conflicts + len(cohort.patients) + (~full_presence).sum() + 1
+    print(f'Presolve: removed {num_nodes - len(node_ids)} of {num_nodes} nodes, {num_trees - len(tree_ids)} of '
+          f'{num_trees} graphs and {num_conflicts - len(pairs)} of {num_conflicts} conflicts; '
+          f'{num_variables} instead of {num_nodes + num_trees + num_conflicts} variables, '
+          f'{num_constraints} instead of {full_constraints} constraints')
+
+    return node_ids, tree_ids, num_shared, constraints
+
+
+def build_model_presolved(m: gp.Model, conflicts: ConflictStore, cohort: Cohort, k: int, names: bool=False,
+                          drop_trees: bool=True):
+    # Gurobi model of get_model_arrays
+    node_ids, tree_ids, num_shared, constraints = get_model_arrays(conflicts, cohort, k, drop_trees)
+    variable_names = ''
+    if names:
+        variable_names = ([conflicts.mutations[v] for v in node_ids] + [cohort.tree_names[t] for t in tree_ids] +
+                          [f'shared_conflicts[{i}]' for i in range(num_shared)])
+    v = m.addMVar(len(node_ids) + len(tree_ids) + num_shared, vtype=GRB.BINARY, name=variable_names)
+    x, y = v[:len(node_ids)], v[len(node_ids):len(node_ids) + len(tree_ids)]
+
+    m.setObjective(x.sum(), GRB.MAXIMIZE)
+    for name, matrix, rhs in constraints:
+        m.addConstr(matrix @ v <= rhs, name=name if names else '')
+    weights = np.asarray(cohort.tree_weights, dtype=float)[tree_ids]
+    k_constraint = m.addConstr(weights @ y >= k, name='k' if names else '')
+
+    return x, y, k_constraint, node_ids, tree_ids
+
+
+def build_model(conflicts: ConflictStore, cohort: Cohort, k: int, cores: int, solution_pool_size: int=5000,
+                verbose: bool=False, builder: str='matrix', names: bool=False, presolve: bool=True,
+                drop_trees: bool=True):
+    """
+    Build the ILP for at least k graphs. Returns the model, the node and graph variables, the constraint on the number
+    of graphs and the node ids and graph indices of the variables (the presolve removes the fixed ones).
+    """
+    if gp is None:
+        print('Error: gurobipy is not installed, use the HiGHS backend with --solver highs')
+        exit(-1)
+
+    m = gp.Model('POTTR')
+    if cores > 0:
+        m.setParam('Threads', cores)
+    m.setParam('OutputFlag', verbose)
+    m.setParam('Seed', 42)
+
+    if solution_pool_size > 0:
+        m.setParam('PoolSearchMode', 2)  # Search for alternative optimal solutions
+        m.setParam('PoolGap', 0.00001)
+        m.setParam('PoolSolutions', solution_pool_size)
+
+    start = time.perf_counter()
+    node_ids, tree_ids = conflicts.nodes, np.arange(len(cohort))
+    if builder == 'loop':
+        x, y, k_constraint = build_model_loop(m, conflicts, cohort, k)
+    elif presolve:
+        x, y, k_constraint, node_ids, tree_ids = build_model_presolved(m, conflicts, cohort, k, names, drop_trees)
+    else:
+        x, y, k_constraint = build_model_matrix(m, conflicts, cohort, k, names)
+    m.update()
+    print(f'Model build ({builder}): {time.perf_counter() - start:.2f}s, {m.NumVars} variables, '
+          f'{m.NumConstrs} constraints, Gurobi memory {m.MemUsed:.3f} GB, '
+          f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+
+    return m, x, y, k_constraint, node_ids, tree_ids
+
+
+def get_solutions(m: gp.Model, x: gp.MVar, y: gp.MVar, node_ids: np.ndarray, tree_ids: np.ndarray, mutations: list):
+    # distinct node sets of all optimal solutions in the pool with the graph indices of their first solution
     max_size = int(m.ObjVal)
     print('Size of a maximum trajectory for this instance is ', max_size)
 
     node_selection = []
     graph_selection = []
     if m.Status == GRB.OPTIMAL:
-        for i in range(m.SolCount):
-            m.setParam('SolutionNumber', i)
-            if int(m.PoolObjVal) == max_size:
-                solution_nodes = sorted([n for n in nodes if nodes[n].Xn > 0.5])
-                solution_graphs = []
-                for patient in input_graphs:
-                    solution_graphs.extend([g for g in input_graphs[patient] if graphs[patient][g.name].Xn > 0.5])
-                if solution_nodes not in node_selection:
-                    node_selection.append(solution_nodes)
-                    graph_selection.append(solution_graphs)
-
-    return node_selection, graph_selection
\ No newline at end of file
+        for selected_nodes, selected_trees in iter_pool_solutions(m, x, y, max_size, set()):
+            node_selection.append(sorted([mutations[v] for v in node_ids[selected_nodes]]))
+            graph_selection.append(tree_ids[selected_trees].tolist())
+
+    return node_selection, graph_selection
+
+
+def iter_pool_solutions(m: gp.Model, x: gp.MVar, y: gp.MVar, max_size: int, seen: set):
+    # selection masks of the pool solutions of size max_size with a node set not in seen, which is updated
+    for i in range(m.SolCount):
+        m.setParam('SolutionNumber', i)
+        if round(m.PoolObjVal) != max_size:
+            continue
+        selected_nodes = x.Xn > 0.5
+        key = selected_nodes.tobytes()
+        if key not in seen:
+            seen.add(key)
+            yield selected_nodes, y.Xn > 0.5
+
+
+def enumerate_solutions(m: gp.Model, x: gp.MVar, y: gp.MVar, node_ids: np.ndarray, tree_ids: np.ndarray,
+                        conflicts: ConflictStore, stream_file: str=None):
+    """
+    Enumerate all maximum node sets with no-good cuts, streaming each trajectory to stream_file. The cuts are removed
+    at the end and the first maximum trajectory is set as start solution.
+    """
+    node_selection, graph_selection = [], []
+    seen, cuts, first = set(), [], None
+    max_size, rounds = None, 0
+    out = open(stream_file, 'w') if stream_file else None
+    try:
+        while True:
+            m.optimize()
+            rounds += 1
+            if m.Status != GRB.OPTIMAL or (max_size is not None and round(m.ObjVal) < max_size):
+                break
+            if max_size is None:
+                max_size = round(m.ObjVal)
+                print('Size of a maximum trajectory for this instance is ', max_size)
+                m.setParam('Cutoff', max_size - 0.5)
+            for selected_nodes, selected_trees in iter_pool_solutions(m, x, y, max_size, seen):
+                node_selection.append(sorted([conflicts.mutations[v] for v in node_ids[selected_nodes]]))
+                graph_selection.append(tree_ids[selected_trees].tolist())
+                first = first or (selected_nodes, selected_trees)
+                cuts.append(m.addConstr(x[np.flatnonzero(selected_nodes)].sum() <= max_size - 1))
+                if out:
+                    out.write(','.join(node_selection[-1]) + ';' +
+                              ','.join(conflicts.tree_names[t] for t in graph_selection[-1]) + '\n')
+                    out.flush()
+    finally:
+        if out:
+            out.close()
+    m.remove(cuts)
+    if first:
+        x.Start, y.Start = first[0].astype(float), first[1].astype(float)
+    print(f'Enumerated {len(node_selection)} maximum trajectories in {rounds} solves')
+    return node_selection, graph_selection
+
+
+def project_mip_start(mip_start: tuple, node_ids: np.ndarray, tree_ids: np.ndarray, cohort: Cohort, k: int):
+    """
+    Start solution restricted to the nodes and graphs kept by the presolve. A subset of the start is still a trajectory,
+    but it is only returned if its graphs stand for at least k patients; otherwise Gurobi would discard it.
+    """
+    kept_nodes, kept_trees = set(node_ids.tolist()), set(tree_ids.tolist())
+    nodes = [v for v in mip_start[0] if v in kept_nodes]
+    trees = [t for t in mip_start[1] if t in kept_trees]
+    if sum(cohort.tree_weights[t] for t in trees) < k:
+        print('MIP start is not used, the presolve removed graphs of the start trajectory')
+        return None
+    return nodes, trees
+
+
+def set_mip_start(x: gp.MVar, y: gp.MVar, node_ids: np.ndarray, tree_ids: np.ndarray, mip_start: tuple):
+    # start solution given by node ids and tree indices, e.g. of solver_heuristic; variables removed by the presolve are 0
+    nodes, trees = mip_start
+    x.Start = np.isin(node_ids, nodes).astype(float)
+    y.Start = np.isin(tree_ids, trees).astype(float)
+    print(f'MIP start with a trajectory of size {len(nodes)}')
+
+
+def find_max_k_common_trajectory(conflicts: ConflictStore, cohort: Cohort, k: int, cores: int, solution_pool_size: int=5000,
+                                 verbose: bool=False, builder: str='matrix', names: bool=False, presolve: bool=True,
+                                 mip_start: tuple=None, enumerate_all: bool=False, stream_file: str=None):
+    """
+    Maximum trajectories of at least k graphs: the distinct node sets of the solution pool or, with enumerate_all, all
+    maximum node sets found by no-good cuts, where the pool size is the number of solutions collected per solve.
+    """
+    m, x, y, _, node_ids, tree_ids = build_model(conflicts, cohort, k, cores, solution_pool_size, verbose, builder,
+                                                 names, presolve)
+    if mip_start:
+        mip_start = project_mip_start(mip_start, node_ids, tree_ids, cohort, k)
+    if mip_start:
+        set_mip_start(x, y, node_ids, tree_ids, mip_start)
+    if enumerate_all:
+        return enumerate_solutions(m, x, y, node_ids, tree_ids, conflicts, stream_file)
+    m.optimize()
+    print(f'Gurobi solved the model in {m.Runtime:.2f}s')
+    return get_solutions(m, x, y, node_ids, tree_ids, conflicts.mutations)
+
+
+def find_max_k_common_trajectory_sweep(conflicts: ConflictStore, cohort: Cohort, k_values: list, cores: int,
+                                       solution_pool_size: int=5000, verbose: bool=False, builder: str='matrix',
+                                       names: bool=False, presolve: bool=True, mip_start: tuple=None,
+                                       enumerate_all: bool=False, stream_file=None):
+    """
+    Solve all k with one model built for the smallest k without dropping graphs, in decreasing k with warm starts.
+    Yields k and the node and graph selections of each k, empty for infeasible k.
+    """
+    k_values = sorted(set(k_values), reverse=True)
+    if not k_values:
+        return
+    m, x, y, k_constraint, node_ids, tree_ids = build_model(conflicts, cohort, k_values[-1], cores, solution_pool_size,
+                                                            verbose, builder, names, presolve, drop_trees=False)
+    if mip_start:
+        mip_start = project_mip_start(mip_start, node_ids, tree_ids, cohort, k_values[0])
+    if mip_start:
+        set_mip_start(x, y, node_ids, tree_ids, mip_start)
+    for k in k_values:
+        start = time.perf_counter()
+        k_constraint.RHS = k
+        if enumerate_all:
+            node_selection, graph_selection = enumerate_solutions(m, x, y, node_ids, tree_ids, conflicts,
+                                                                  stream_file(k) if stream_file else None)
+            print(f'Solved k={k} in {time.perf_counter() - start:.2f}s')
+            yield k, node_selection, graph_selection
+            continue
+
+        m.optimize()
+        if m.Status != GRB.OPTIMAL:
+            print(f'No trajectory for k={k} (Gurobi status {m.Status})')
+            yield k, [], []
+            continue
+
+        print(f'Solved k={k} in {time.perf_counter() - start:.2f}s')
+        yield (k,) + get_solutions(m, x, y, node_ids, tree_ids, conflicts.mutations)
+        m.setParam('SolutionNumber', 0)
+        x.Start, y.Start = x.Xn, y.Xn
+        m.setParam('Cutoff', m.ObjVal - 0.5)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------- #
+#                                    IMPORTS                                   #
+# ---------------------------------------------------------------------------- #
+import os
+import argparse
+import glob
+import tempfile
+import time
+import POTTR
+import solver_highs
+from read_input_dags import read_cohort
+from compute_conflict_graph import get_pair_free_conflict_graph
+
+
+# ---------------------------------------------------------------------------- #
+#                                   FUNCTIONS                                  #
+# ---------------------------------------------------------------------------- #
+def get_parser():
+    parser = argparse.ArgumentParser(description='Compare build and solve time of the MILP backends')
+    parser.add_argument('--dags', '-d', default='../data/simulated_dags', dest='dags', type=str,
+                        help='Directory with one sub directory of input DAGs per instance size')
+    parser.add_argument('--k', '-k', default=5, dest='k', type=int,
+                        help='Number k of incomplete posets to search for common trajectory')
+    parser.add_argument('--solvers', '-s', nargs='+', default=['gurobi', 'highs'], choices=['gurobi', 'highs'],
+                        help='Backends to compare')
+    parser.add_argument('--cores', '-c', dest='cores', type=int, default=1,
+                        help='Number of cores used to read the input and by Gurobi')
+    parser.add_argument('--output', '-o', dest='output', type=str,
+                        help='Optional csv file to write the results to')
+    return parser
+
+
+def run_gurobi(conflicts, cohort, k: int, cores: int):
+    start = time.perf_counter()
+    m, x, y, _, node_ids, tree_ids = POTTR.build_model(conflicts, cohort, k, cores, solution_pool_size=0)
+    built = time.perf_counter()
+    m.optimize()
+    return built - start, time.perf_counter() - built, int(m.ObjVal)
+
+
+def run_highs(conflicts, cohort, k: int, cores: int):
+    start = time.perf_counter()
+    model = solver_highs.build_model(conflicts, cohort, k)
+    built = time.perf_counter()
+    result = solver_highs.solve(model, k)
+    return built - start, time.perf_counter() - built, int(round(-result.fun)) if result.status == 0 else None
+
+
+def instance_size(directory: str):
+    # simulated instances are named after their number of trees, e.g. tracerx_128
+    digits = ''.join(c for c in os.path.basename(directory) if c.isdigit())
+    return int(digits) if digits else 0
+
+
+def main():
+    args = get_parser().parse_args()
+    runs = {'gurobi': run_gurobi, 'highs': run_highs}
+    instances = sorted((d for d in glob.glob(os.path.join(args.dags, '*')) if os.path.isdir(d)), key=instance_size)
+
+    rows = ['instance,trees,conflicts,solver,build_s,solve_s,objective']
+    with tempfile.TemporaryDirectory() as out:
+        for instance in instances:
+            cohort = read_cohort(instance, out, args.cores)
+            conflicts = get_pair_free_conflict_graph(cohort)
+            for solver in args.solvers:
+                try:
+                    build_time, solve_time, objective = runs[solver](conflicts, cohort, min(args.k, len(cohort.patients)),
+                                                                     args.cores)
+                except Exception as e:
+                    print(f'{solver} failed on {instance}: {e}')
+                    build_time, solve_time, objective = float('nan'), float('nan'), None
+                rows.append(f'{os.path.basename(instance)},{len(cohort)},{len(conflicts)},{solver},'
+                            f'{build_time:.3f},{solve_time:.3f},{objective}')
+                print(rows[-1])
+
+    print('\n'.join(rows))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(rows) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# ---------------------------------------------------------------------------- #
+#                                    IMPORTS                                   #
+# ---------------------------------------------------------------------------- #
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from cohort import Cohort
+from conflict_store import ConflictStore
+
+# ---------------------------------------------------------------------------- #
+#                               GLOBAL VARIABLES                               #
+# ---------------------------------------------------------------------------- #
+# increase if parsing of the input or the computation of the conflict graph changes, old entries are not used anymore
+CACHE_VERSION = 5
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pottr')
+
+
+# ---------------------------------------------------------------------------- #
+#                                   FUNCTIONS                                  #
+# ---------------------------------------------------------------------------- #
+def input_files(path: str):
+    # all files read by collect_input_trees for the given input path, a single input file is hashed whatever its type
+    if os.path.isfile(path):
+        return [path]
+    return sorted(glob.glob(path + '/*.txt')) + sorted(glob.glob(path + '/*.gexf'))
+
+
+def input_key(path: str):
+    """
+    Content address of an input: hash of the cache version and the names and contents of all input files. File names
+    are part of the key since patients and trees are named after them.
+    """
+    digest = hashlib.sha256(f'POTTR cache {CACHE_VERSION}\n'.encode())
+    for file in input_files(path):
+        digest.update(os.path.basename(file).encode() + b'\0')
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def entry_size(entry: str):
+    return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+
+def clear(cache_dir: str):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    print(f'Cleared cache {cache_dir}')
+
+
+def load(cache_dir: str, key: str):
+    """
+    Cohort and union conflict graph (including the potential conflicts) stored for key or None on a cache miss. A hit
+    marks the entry as recently used.
+    """
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry, 'cohort.pkl'), 'rb') as f:
+            cohort = pickle.load(f)
+        conflicts = ConflictStore.load(os.path.join(entry, 'conflicts.npz'))
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError, ValueError):
+        print(f'Cache miss for input {key[:12]}')
+        return None
+    os.utime(entry)
+    print(f'Cache hit for input {key[:12]}, skip reading trees and computing the conflict graph')
+    return cohort, conflicts
+
+
+def store(cache_dir: str, key: str, cohort: Cohort, conflicts: ConflictStore, max_size: float, max_age: float):
+    """
+    Store the cohort and union conflict graph for key and evict old entries: entries older than max_age days are
+    removed, then the least recently used entries until the cache is at most max_size MB.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # written to a temporary directory first, so that parallel runs never read a partial entry
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    with open(os.path.join(tmp, 'cohort.pkl'), 'wb') as f:
+        pickle.dump(cohort, f, protocol=pickle.HIGHEST_PROTOCOL)
+    conflicts.save(os.path.join(tmp, 'conflicts.npz'))
+    entry = os.path.join(cache_dir, key)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # entry was written by another run in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f'Cached input {key[:12]} in {cache_dir}')
+    evict(cache_dir, max_size, max_age)
+
+
+def evict(cache_dir: str, max_size: float, max_age: float):
+    entries = [os.path.join(cache_dir, e) for e in os.listdir(cache_dir) if not e.startswith('.')]
+    entries.sort(key=os.path.getmtime)
+    now = time.time()
+    sizes = {entry: entry_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    # the most recent entry, usually the one just stored, is always kept
+    for entry in entries[:-1]:
+        if now - os.path.getmtime(entry) <= max_age * 86400 and total <= max_size * 2 ** 20:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+        print(f'Evicted cache entry {os.path.basename(entry)[:12]}')
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------- #
+#                                    IMPORTS                                   #
+# ---------------------------------------------------------------------------- #
+import sys
+import argparse
+import tempfile
+import POTTR
+import solver_highs
+import solver_bnb
+from cohort import Cohort
+from conflict_store import ConflictStore
+from read_input_dags import read_cohort
+from compute_conflict_graph import get_pair_free_conflict_graph
+
+
+# ---------------------------------------------------------------------------- #
+#                                   FUNCTIONS                                  #
+# ---------------------------------------------------------------------------- #
+def get_parser():
+    parser = argparse.ArgumentParser(description='Check that the --k-range sweep finds the same maximum trajectories '
+                                                 'as separate runs for each k')
+    parser.add_argument('--dags', '-d', required=True, dest='dags', type=str,
+                        help='File or directory containing transitively closed DAGs (incomplete posets)')
+    parser.add_argument('--k-range', '-kr', required=True, nargs=2, dest='k_range', type=int, metavar=('min', 'max'),
+                        help='Values of k to compare')
+    parser.add_argument('--solver', '-solver', default='gurobi', choices=['gurobi', 'highs', 'bnb'], dest='solver',
+                        help='Solver of both the sweep and the separate runs')
+    parser.add_argument('--cores', '-c', dest='cores', type=int, default=1,
+                        help='Number of cores used to read the input and by Gurobi')
+    return parser
+
+
+def trajectory_size(node_selection: list):
+    # size of the maximum trajectories, None if k is infeasible
+    return len(node_selection[0]) if node_selection else None
+
+
+def get_k_values(cohort: Cohort, k_min: int, k_max: int):
+    # k of the range up to the number of input patients, which a deduplicated cohort counts by its patient weights
+    return range(max(1, k_min), min(k_max, sum(cohort.patient_weights())) + 1)
+
+
+def compare_sweep(conflicts: ConflictStore, cohort: Cohort, k_values: range, solver_name: str, cores: int=1):
+    """
+    Solve all k with the sweep and separately. Yields k, the trajectory sizes of the sweep and of the single run and
+    whether both agree.
+    """
+    solver = {'gurobi': POTTR, 'highs': solver_highs, 'bnb': solver_bnb}[solver_name]
+    # without a pool, Gurobi and HiGHS report one of possibly several maximum trajectories, so only sizes are compared
+    sweep = solver.find_max_k_common_trajectory_sweep(conflicts, cohort, k_values, cores, 0)
+    for k, node_selection, _ in sweep:
+        single, _ = solver.find_max_k_common_trajectory(conflicts, cohort, k, cores, 0)
+        same = trajectory_size(node_selection) == trajectory_size(single)
+        if solver_name == 'bnb':
+            # the branch and bound returns all maximum trajectories
+            same = same and sorted(node_selection) == sorted(single)
+        yield k, trajectory_size(node_selection), trajectory_size(single), same
+
+
+def main():
+    args = get_parser().parse_args()
+    with tempfile.TemporaryDirectory() as out:
+        cohort, _ = read_cohort(args.dags, out, args.cores).deduplicate()
+    conflicts = get_pair_free_conflict_graph(cohort)
+    k_values = get_k_values(cohort, *args.k_range)
+
+    failures = 0
+    for k, sweep_size, single_size, same in compare_sweep(conflicts, cohort, k_values, args.solver, args.cores):
+        print(f'k={k}: sweep {sweep_size}, single run {single_size}' + ('' if same else ', DIFFERENT'))
+        failures += not same
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
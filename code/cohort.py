@@ -0,0 +1,399 @@
+# ---------------------------------------------------------------------------- #
+#                                    IMPORTS                                   #
+# ---------------------------------------------------------------------------- #
+import copy
+import numpy as np
+import networkx as nx
+from multiprocessing import shared_memory
+
+# ---------------------------------------------------------------------------- #
+#                               GLOBAL VARIABLES                               #
+# ---------------------------------------------------------------------------- #
+ROOT = '0'
+
+# relation codes of an ordered node pair (a, b) in one tree; codes of two trees are combined with a bitwise or
+BEFORE = 1          # a precedes b
+AFTER = 2           # b precedes a
+INCOMPARABLE = 4    # neither order nor cluster
+CLUSTER = 8         # a and b are in the same cluster (hidden order a ~ b)
+
+
+# ---------------------------------------------------------------------------- #
+#                                   FUNCTIONS                                  #
+# ---------------------------------------------------------------------------- #
+def iter_bits(bitset: int):
+    # yield the positions of all set bits, lowest first
+    while bitset:
+        low = bitset & -bitset
+        yield low.bit_length() - 1
+        bitset ^= low
+
+
+def bitset_closure(nodes: list, edges: list):
+    """
+    Transitive closure of a DAG given by integer node ids. Returns a dict mapping each node to the bitset of all its
+    (strict) successors or None if the graph contains a cycle.
+    """
+    children = {v: [] for v in nodes}
+    indegree = dict.fromkeys(nodes, 0)
+    for a, b in edges:
+        children[a].append(b)
+        indegree[b] += 1
+
+    # Kahn's algorithm, the list is extended while we iterate over it
+    order = [v for v in nodes if indegree[v] == 0]
+    for v in order:
+        for c in children[v]:
+            indegree[c] -= 1
+            if indegree[c] == 0:
+                order.append(c)
+    if len(order) != len(nodes):
+        return None
+
+    # successors are closed before their predecessors in reversed topological order
+    reach = dict()
+    for v in reversed(order):
+        closed = 0
+        for c in children[v]:
+            closed |= reach[c] | (1 << c)
+        reach[v] = closed
+    return reach
+
+
+def hidden_orders(nodes: list, reach: dict, cluster_nodes: dict):
+    """
+    Hidden orders of a tree as read by get_conflict_graph_for_pair: incomparable mutations a, b, a before b in the node
+    order of the tree, with b in the cluster_nodes of a. Returns the symmetric bitsets of the hidden orders per mutation.
+    """
+    position = {v: i for i, v in enumerate(nodes)}
+    partners = dict()
+    for a, cluster in cluster_nodes.items():
+        for b in cluster:
+            if b in position and position[a] < position[b] and not (reach[a] >> b & 1 or reach[b] >> a & 1):
+                partners[a] = partners.get(a, 0) | 1 << b
+                partners[b] = partners.get(b, 0) | 1 << a
+    return partners
+
+
+def relation_matrix_views(buffer, id_offsets: np.ndarray, code_offsets: np.ndarray):
+    # (ids, codes) of each tree as views into a buffer laid out as by Cohort.share_relation_matrices
+    ids = np.ndarray(id_offsets[-1], dtype=np.int64, buffer=buffer)
+    codes = np.ndarray(code_offsets[-1], dtype=np.uint8, buffer=buffer, offset=ids.nbytes)
+    relations = []
+    for t in range(len(id_offsets) - 1):
+        size = id_offsets[t + 1] - id_offsets[t]
+        relations.append((ids[id_offsets[t]:id_offsets[t + 1]],
+                          codes[code_offsets[t]:code_offsets[t + 1]].reshape(size, size)))
+    return relations
+
+
+def attach_relation_matrices(layout: tuple):
+    """
+    Attach to the relation matrices shared by Cohort.share_relation_matrices. Returns the shared memory block, which has
+    to stay open while the matrices are used, and the list of (ids, codes) per tree as views into the block.
+    """
+    name, id_offsets, code_offsets = layout
+    block = shared_memory.SharedMemory(name=name)
+    return block, relation_matrix_views(block.buf, id_offsets, code_offsets)
+
+
+class Cohort:
+    """
+    Interned input incomplete posets: per tree the bitset of its mutations, of the successors and of the hidden
+    orders of each mutation, and per mutation the bitset of trees containing it.
+    """
+
+    def __init__(self):
+        self.mutations = []         # interned id -> mutation name
+        self.mutation_index = {}    # mutation name -> interned id
+        self.mutation_trees = []    # interned id -> bitset of trees containing the mutation
+        self.patients = []          # evolution ids in input order
+        self.patient_index = {}     # evolution id -> position in patients
+        self.patient_trees = []     # tree indices of each patient
+        self.tree_names = []
+        self.tree_patient = []      # position of the patient of each tree
+        self.tree_nodes = []        # bitset of mutations of each tree
+        self.tree_reach = []        # per tree: mutation id -> bitset of successors
+        self.tree_clusters = []     # per tree: mutation id -> bitset of its hidden orders (only for clustered mutations)
+        self.tree_weights = []      # number of patients each tree stands for, only > 1 in a deduplicated cohort
+        self.tree_copies = []       # number of input trees each tree stands for, only > 1 in a deduplicated cohort
+        self.intern(ROOT)
+
+    def __len__(self):
+        return len(self.tree_names)
+
+    def intern(self, name: str):
+        if name not in self.mutation_index:
+            self.mutation_index[name] = len(self.mutations)
+            self.mutations.append(name)
+            self.mutation_trees.append(0)
+        return self.mutation_index[name]
+
+    def add_tree(self, evolution: str, name: str, nodes, edges, cluster_nodes=None):
+        """
+        Add a tree given by mutation names in node order, edges and cluster_nodes attributes (see hidden_orders).
+        Returns the index of the new tree or None if the tree is not a DAG.
+        """
+        ids = [self.intern(ROOT)] + [self.intern(n) for n in nodes if n != ROOT]
+        id_edges = [(self.intern(a), self.intern(b)) for a, b in edges]
+        ids.extend(v for pair in id_edges for v in pair)
+        ids = list(dict.fromkeys(ids))
+        id_edges.extend((0, v) for v in ids if v != 0)
+
+        if evolution not in self.patient_index:
+            self.patient_index[evolution] = len(self.patients)
+            self.patients.append(evolution)
+            self.patient_trees.append([])
+
+        reach = bitset_closure(ids, id_edges)
+        if reach is None:
+            print('Error message: graph contains a cycle')
+            print(name)
+            return None
+
+        # cluster_nodes may name nodes that are not part of the tree, they are ignored
+        names = {self.mutations[v] for v in ids}
+        id_clusters = {self.mutation_index[n]: [self.mutation_index[c] for c in cluster if c in names]
+                       for n, cluster in (cluster_nodes or {}).items() if n in names}
+
+        tree = len(self.tree_names)
+        self.patient_trees[self.patient_index[evolution]].append(tree)
+        self.tree_names.append(str(name))
+        self.tree_patient.append(self.patient_index[evolution])
+        self.tree_nodes.append(sum(1 << v for v in ids))
+        self.tree_reach.append(reach)
+        self.tree_clusters.append(hidden_orders(ids, reach, id_clusters))
+        self.tree_weights.append(1)
+        self.tree_copies.append(1)
+        for v in ids:
+            self.mutation_trees[v] |= 1 << tree
+        return tree
+
+    def add_graph(self, evolution: str, graph: nx.DiGraph):
+        # cluster_nodes are sets for graphs built from lines and comma separated strings in gexf files
+        cluster_nodes = dict()
+        for n, cluster in graph.nodes(data='cluster_nodes'):
+            if isinstance(cluster, str):
+                cluster = cluster.split(',') if cluster else []
+            if cluster:
+                cluster_nodes[n] = cluster
+        return self.add_tree(evolution, graph.name, graph.nodes, graph.edges, cluster_nodes)
+
+    @classmethod
+    def from_graphs(cls, graphs_dict: dict):
+        cohort = cls()
+        for evolution in graphs_dict:
+            for graph in graphs_dict[evolution]:
+                cohort.add_graph(evolution, graph)
+        return cohort
+
+    def nodes(self, tree: int):
+        return list(iter_bits(self.tree_nodes[tree]))
+
+    def node_names(self, tree: int):
+        return [self.mutations[v] for v in iter_bits(self.tree_nodes[tree])]
+
+    def tree_key(self, tree: int):
+        # equal for trees with the same closed poset, mutation ids are shared by all trees
+        return (self.tree_nodes[tree], tuple(sorted(self.tree_reach[tree].items())),
+                tuple(sorted(self.tree_clusters[tree].items())))
+
+    def patient_weights(self):
+        # a patient with a weighted tree has no other trees, so all trees of a patient have the same weight
+        return [self.tree_weights[trees[0]] if trees else 0 for trees in self.patient_trees]
+
+    def deduplicate(self):
+        """
+        Cohort of the distinct closed posets, equal trees collapsed within a patient and across patients with a single
+        distinct poset (weighted). Returns it and the trees each of its trees stands for, the representative first.
+        """
+        keys = [self.tree_key(t) for t in range(len(self))]
+        distinct_per_patient = [len(set(keys[t] for t in trees)) for trees in self.patient_trees]
+        classes = dict()
+        for t in range(len(self)):
+            p = self.tree_patient[t]
+            classes.setdefault((keys[t],) if distinct_per_patient[p] == 1 else (keys[t], p), []).append(t)
+
+        deduplicated = Cohort()
+        deduplicated.mutations = list(self.mutations)
+        deduplicated.mutation_index = dict(self.mutation_index)
+        deduplicated.mutation_trees = [0] * len(self.mutations)
+        members = list(classes.values())
+        for tree, trees in enumerate(members):
+            t = trees[0]
+            evolution = self.patients[self.tree_patient[t]]
+            if evolution not in deduplicated.patient_index:
+                deduplicated.patient_index[evolution] = len(deduplicated.patients)
+                deduplicated.patients.append(evolution)
+                deduplicated.patient_trees.append([])
+            deduplicated.patient_trees[deduplicated.patient_index[evolution]].append(tree)
+            deduplicated.tree_names.append(self.tree_names[t])
+            deduplicated.tree_patient.append(deduplicated.patient_index[evolution])
+            deduplicated.tree_nodes.append(self.tree_nodes[t])
+            deduplicated.tree_reach.append(self.tree_reach[t])
+            deduplicated.tree_clusters.append(self.tree_clusters[t])
+            deduplicated.tree_weights.append(len({self.tree_patient[m] for m in trees}))
+            deduplicated.tree_copies.append(sum(self.tree_copies[m] for m in trees))
+            for v in iter_bits(self.tree_nodes[t]):
+                deduplicated.mutation_trees[v] |= 1 << tree
+        return deduplicated, members
+
+    def expand_trees(self, trees, members: list):
+        # trees of this cohort selected by the given trees of its deduplicated cohort, one per patient
+        expanded = []
+        for t in trees:
+            patients = set()
+            for m in members[t]:
+                if self.tree_patient[m] not in patients:
+                    patients.add(self.tree_patient[m])
+                    expanded.append(m)
+        return expanded
+
+    def precedes(self, tree: int, a: int, b: int):
+        return bool(self.tree_reach[tree][a] >> b & 1) if a in self.tree_reach[tree] else False
+
+    def same_cluster(self, tree: int, a: int, b: int):
+        return bool(self.tree_clusters[tree].get(a, 0) >> b & 1) and a != b
+
+    def trees_containing(self, names):
+        # bitset of the trees containing all given mutations, an intersection of the inverted index
+        trees = (1 << len(self)) - 1
+        for name in names:
+            if name not in self.mutation_index:
+                return 0
+            trees &= self.mutation_trees[self.mutation_index[name]]
+        return trees
+
+    def supporting_trees(self, nodes, edges, exact: bool=True, resolve: bool=False, resolvable=None):
+        """
+        Bitset of the trees with equal (exact) or more orders on the mutations of a trajectory. With resolve, missing
+        orders may also be hidden orders in the set resolvable (all, if None), see resolvable_orders.
+        """
+        trees = self.trees_containing(nodes)
+        if not trees:
+            return 0
+        ids = list(dict.fromkeys(self.mutation_index[n] for n in nodes))
+        reach = bitset_closure(ids, [(self.mutation_index[a], self.mutation_index[b]) for a, b in edges])
+        if reach is None:
+            return 0
+        mask = sum(1 << v for v in ids)
+
+        supported = 0
+        for t in iter_bits(trees):
+            tree_reach = self.tree_reach[t]
+            if resolve:
+                match = all(not tree_reach[v] & mask & ~reach[v] and
+                            self.resolves(t, v, reach[v] & ~tree_reach[v], resolvable) for v in ids)
+            elif exact:
+                match = all(tree_reach[v] & mask == reach[v] for v in ids)
+            else:
+                match = all(not reach[v] & ~tree_reach[v] for v in ids)
+            if match:
+                supported |= 1 << t
+        return supported
+
+    def resolves(self, tree: int, a: int, successors: int, resolvable=None):
+        # True if the hidden orders of a to the bitset of successors may be resolved to orders a precedes successor
+        if successors & ~self.tree_clusters[tree].get(a, 0):
+            return False
+        return resolvable is None or all((a, b) in resolvable for b in iter_bits(successors))
+
+    def resolvable_orders(self, threshold: int=1, frequency: bool=False):
+        """
+        Directed mutation id pairs (a, b) whose hidden orders may be resolved to a precedes b, i.e. the potential
+        conflicts left by add_resolution_threshold_conflicts and, with frequency, add_low_frequency_conflicts.
+        """
+        hidden = dict()
+        for t in range(len(self)):
+            for a, cluster in self.tree_clusters[t].items():
+                for b in iter_bits(cluster):
+                    if a < b and not self.tree_reach[t][a] >> b & 1 and not self.tree_reach[t][b] >> a & 1:
+                        hidden.setdefault((a, b), set()).add(self.tree_patient[t])
+
+        counts = dict()
+        for (a, b), patients in hidden.items():
+            for t in iter_bits(self.mutation_trees[a] & self.mutation_trees[b]):
+                if patients - {self.tree_patient[t]}:
+                    for order in ((a, b), (b, a)):
+                        if self.tree_reach[t][order[0]] >> order[1] & 1:
+                            counts[order] = counts.get(order, 0) + self.tree_copies[t]
+        return {(a, b) for (a, b), count in counts.items()
+                if count >= threshold and not (frequency and counts.get((b, a), 0) > count)}
+
+    def shuffle_labels(self, rng: np.random.Generator):
+        """
+        Copy of the cohort in which the mutations of each tree are randomly relabelled among themselves, e.g. for
+        permutation tests. Names and inverted index are shared, only the relations are new.
+        """
+        shuffled = copy.copy(self)
+        shuffled.tree_reach = []
+        shuffled.tree_clusters = []
+        for t in range(len(self)):
+            ids = [v for v in iter_bits(self.tree_nodes[t]) if v != 0]
+            mapping = dict(zip(ids, rng.permutation(ids).tolist()))
+            mapping[0] = 0
+            shuffled.tree_reach.append({mapping[v]: sum(1 << mapping[s] for s in iter_bits(reach))
+                                        for v, reach in self.tree_reach[t].items()})
+            shuffled.tree_clusters.append({mapping[v]: sum(1 << mapping[c] for c in iter_bits(cluster))
+                                           for v, cluster in self.tree_clusters[t].items()})
+        return shuffled
+
+    def relation_matrix(self, tree: int):
+        """
+        Relation codes of all node pairs of a tree. Returns the sorted mutation ids of the tree and a square uint8 matrix
+        with the code of each pair of these ids.
+        """
+        ids = np.array(self.nodes(tree), dtype=np.int64)
+        reach = np.zeros((len(ids), len(ids)), dtype=bool)
+        cluster = np.zeros((len(ids), len(ids)), dtype=bool)
+        for i, v in enumerate(ids):
+            reach[i, np.searchsorted(ids, list(iter_bits(self.tree_reach[tree][v])))] = True
+            if v in self.tree_clusters[tree]:
+                cluster[i, np.searchsorted(ids, list(iter_bits(self.tree_clusters[tree][v])))] = True
+
+        incomparable = ~(reach | reach.T)
+        np.fill_diagonal(incomparable, False)
+        codes = np.zeros((len(ids), len(ids)), dtype=np.uint8)
+        codes[reach] = BEFORE
+        codes[reach.T] = AFTER
+        codes[incomparable & cluster] = CLUSTER
+        codes[incomparable & ~cluster] = INCOMPARABLE
+        return ids, codes
+
+    def relation_matrices(self):
+        return [self.relation_matrix(t) for t in range(len(self))]
+
+    def share_relation_matrices(self):
+        """
+        Write the sorted ids and code matrices of all trees into one block of shared memory. Returns the block, to be
+        closed and unlinked by the caller, and the layout to pass to attach_relation_matrices.
+        """
+        sizes = np.array([bin(nodes).count('1') for nodes in self.tree_nodes], dtype=np.int64)
+        id_offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        code_offsets = np.concatenate(([0], np.cumsum(sizes ** 2))).astype(np.int64)
+        block = shared_memory.SharedMemory(create=True, size=max(1, 8 * int(id_offsets[-1]) + int(code_offsets[-1])))
+        # matrices are computed one at a time, so they are never held twice in memory
+        for t, (ids, codes) in enumerate(relation_matrix_views(block.buf, id_offsets, code_offsets)):
+            ids[:], codes[:] = self.relation_matrix(t)
+        return block, (block.name, id_offsets, code_offsets)
+
+    def to_graph(self, tree: int):
+        # networkx view of a tree, equal to the transitively closed graph built by create_graphs except that cluster_nodes
+        # hold the symmetric hidden orders of each node
+        graph = nx.DiGraph()
+        graph.name = self.tree_names[tree]
+        graph.add_nodes_from(self.node_names(tree))
+        for v, successors in self.tree_reach[tree].items():
+            graph.add_edges_from((self.mutations[v], self.mutations[s]) for s in iter_bits(successors))
+        for v, cluster in self.tree_clusters[tree].items():
+            graph.nodes[self.mutations[v]]['cluster_nodes'] = {self.mutations[c] for c in iter_bits(cluster) if c != v}
+        return graph
+
+    def to_graphs(self):
+        return [self.to_graph(t) for t in range(len(self))]
+
+    def to_graphs_dict(self, graphs: list=None):
+        # graphs can be the list returned by to_graphs to share the graph objects
+        if graphs is None:
+            graphs = self.to_graphs()
+        return {evolution: [graphs[t] for t in self.patient_trees[p]] for p, evolution in enumerate(self.patients)}
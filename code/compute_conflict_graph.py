@@ -2,9 +2,19 @@ import os
 import itertools
 import networkx as nx
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, deque
 from scipy.special import comb
 from multiprocessing import Pool
+from cohort import Cohort, attach_relation_matrices, iter_bits, BEFORE, AFTER, INCOMPARABLE, CLUSTER
+from conflict_store import ConflictStore
+
+# a combined relation code is a conflict if it contains two different orders / incomparability or if the pair is
+# incomparable in one tree but clustered in the other
+CONFLICT_CODES = np.array([bin(code & (BEFORE | AFTER | INCOMPARABLE)).count('1') > 1 or
+                           code & (INCOMPARABLE | CLUSTER) == INCOMPARABLE | CLUSTER for code in range(16)])
+
+# maximal number of tree pairs per task of the parallel conflict computation
+PAIR_RANGE_SIZE = 2000
 
 
 def get_conflict_graph_for_pair(graph_pair: list):
@@ -73,6 +83,318 @@ def get_conflict_graph_for_pair(graph_pair: list):
     return conflict_graph, potential_conflicts
 
 
+def get_conflict_arrays_for_pair(relations1: tuple, relations2: tuple):
+    """
+    Vectorized version of get_conflict_graph_for_pair on the relation matrices of two trees. Returns the common mutation
+    ids, the conflicting id pairs and the potential conflicts as directed id pairs (a, b), where a precedes b in one tree
+    and a ~ b in the other, together with a flag whether the order a precedes b is observed in the first tree.
+    """
+    ids1, codes1 = relations1
+    ids2, codes2 = relations2
+    common, index1, index2 = np.intersect1d(ids1, ids2, assume_unique=True, return_indices=True)
+    upper = np.triu_indices(len(common), 1)
+    first = codes1[index1[upper[0]], index1[upper[1]]]
+    combined = first | codes2[index2[upper[0]], index2[upper[1]]]
+    a, b = common[upper[0]], common[upper[1]]
+
+    conflicts = CONFLICT_CODES[combined]
+    forward = combined & (BEFORE | CLUSTER) == BEFORE | CLUSTER
+    backward = combined & (AFTER | CLUSTER) == AFTER | CLUSTER
+    potential_conflicts = (np.concatenate((a[forward], b[backward])),
+                           np.concatenate((b[forward], a[backward])),
+                           np.concatenate((first[forward] & BEFORE > 0, first[backward] & AFTER > 0)))
+
+    return common, (a[conflicts], b[conflicts]), potential_conflicts
+
+
+def get_cohort_tree_pairs(cohort: Cohort):
+    # all pairs of trees of distinct patients, ordered by the patients
+    tree_pairs = []
+    for p1, p2 in itertools.combinations(range(len(cohort.patients)), 2):
+        tree_pairs.extend(itertools.product(cohort.patient_trees[p1], cohort.patient_trees[p2]))
+    return tree_pairs
+
+
+def get_tree_pair_index(cohort: Cohort):
+    """
+    Index of all pairs of trees of distinct patients that does not materialize the pairs. The trees are ordered by
+    patient, the tree at position i is paired with all trees from position ends[i] on and offsets[i] is the number of
+    pairs of the trees before position i, so a pair is identified by an integer in [0, offsets[-1]).
+    """
+    order = np.array([t for trees in cohort.patient_trees for t in trees], dtype=np.int64)
+    sizes = np.array([len(trees) for trees in cohort.patient_trees], dtype=np.int64)
+    ends = np.repeat(np.cumsum(sizes), sizes)
+    offsets = np.concatenate(([0], np.cumsum(len(order) - ends))).astype(np.int64)
+    return order, ends, offsets
+
+
+def get_tree_pairs_in_range(pair_index: tuple, start: int, stop: int):
+    # tree pairs with the integers start, ..., stop - 1 of a tree pair index, the first tree belongs to the first patient
+    order, ends, offsets = pair_index
+    pairs = np.arange(start, stop, dtype=np.int64)
+    first = np.searchsorted(offsets, pairs, side='right') - 1
+    second = ends[first] + pairs - offsets[first]
+    return list(zip(order[first].tolist(), order[second].tolist()))
+
+
+def iter_ranges(size: int, range_size: int):
+    for start in range(0, size, range_size):
+        yield start, min(start + range_size, size)
+
+
+def get_conflict_arrays_for_tree_pairs(relations: list, tree_pairs: list):
+    """
+    Conflicts of several tree pairs concatenated into flat arrays: the common mutation ids, the conflicting mutation ids
+    a, b with their trees t1, t2 and the potential conflicts as directed mutation ids with their trees and the tree the
+    order is observed in.
+    """
+    nodes, a, b, t1, t2, source, target, p1, p2, edge_trees = ([np.zeros(0, dtype=np.int64)] for _ in range(10))
+    for g1, g2 in tree_pairs:
+        common, (u, v), (s, t, in_first) = get_conflict_arrays_for_pair(relations[g1], relations[g2])
+        nodes.append(common)
+        a.append(u)
+        b.append(v)
+        t1.append(np.full(len(u), g1, dtype=np.int64))
+        t2.append(np.full(len(u), g2, dtype=np.int64))
+        source.append(s)
+        target.append(t)
+        p1.append(np.full(len(s), g1, dtype=np.int64))
+        p2.append(np.full(len(s), g2, dtype=np.int64))
+        edge_trees.append(np.where(in_first, g1, g2))
+    return tuple(np.concatenate(column) for column in (nodes, a, b, t1, t2, source, target, p1, p2, edge_trees))
+
+
+def encode_conflict_arrays(store: ConflictStore, arrays: tuple):
+    """
+    Encode the arrays of get_conflict_arrays_for_tree_pairs as columns of a ConflictStore: the unique common mutations,
+    the mutation pairs and tree pairs of the conflicts and the directed mutation pairs, tree pairs and edge trees of the
+    potential conflicts.
+    """
+    nodes, a, b, t1, t2, source, target, p1, p2, edge_trees = arrays
+    return (np.unique(nodes), store.encode_pairs(a, b), store.encode_tree_pairs(t1, t2),
+            source * store.num_mutations + target, store.encode_tree_pairs(p1, p2), edge_trees)
+
+
+def add_encoded_conflicts(store: ConflictStore, columns: tuple):
+    nodes, pairs, tree_pairs, potential_pairs, potential_tree_pairs, edge_trees = columns
+    store.nodes = np.union1d(store.nodes, nodes)
+    store.add_conflicts(pairs, tree_pairs)
+    store.add_potential_conflicts(potential_pairs, potential_tree_pairs, edge_trees)
+
+
+def add_conflict_arrays(store: ConflictStore, arrays: tuple):
+    add_encoded_conflicts(store, encode_conflict_arrays(store, arrays))
+
+
+def init_relations_worker(layout: tuple, store: ConflictStore, pair_index: tuple=None):
+    """
+    Attach a worker to the relation matrices in shared memory. The empty store (mutation table, trees and patients) and
+    the tree pair index are sent once per worker, the tasks are only tree pairs or ranges of the tree pair index.
+    """
+    global worker_block, worker_relations, worker_store, worker_pair_index
+    worker_block, worker_relations = attach_relation_matrices(layout)
+    worker_store = store
+    worker_pair_index = pair_index
+
+
+def process_tree_pair_split(split: list):
+    return encode_conflict_arrays(worker_store, get_conflict_arrays_for_tree_pairs(worker_relations, split))
+
+
+def process_tree_pair_range(pair_range: tuple):
+    tree_pairs = get_tree_pairs_in_range(worker_pair_index, *pair_range)
+    return encode_conflict_arrays(worker_store, get_conflict_arrays_for_tree_pairs(worker_relations, tree_pairs))
+
+
+def imap_bounded(pool: Pool, function, tasks, max_pending: int):
+    # like pool.imap, but the tasks are consumed lazily and at most max_pending tasks are submitted at any time
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def get_cohort_conflict_graph(cohort: Cohort, tree_pairs: list=None, verbose: bool=False, num_workers: int=0):
+    """
+    Union conflict graph and potential conflicts of the given tree pairs of a cohort, computed from the relation matrices
+    of the trees. Same conflicts as get_conflict_graphs_single_thread, but stored in a ConflictStore. Without tree pairs,
+    all pairs of trees of distinct patients are streamed as ranges of a tree pair index. With num_workers > 0, the
+    relation matrices are placed once in shared memory and the ranges are processed by a pool of workers with at most
+    two tasks per worker in flight, which only return encoded conflict arrays.
+    """
+    if verbose:
+        print('Create union conflict graph from relation matrices')
+
+    store = ConflictStore.from_cohort(cohort)
+    if tree_pairs is None:
+        pair_index = get_tree_pair_index(cohort)
+        num_pairs = int(pair_index[2][-1])
+        range_size = max(1, min(PAIR_RANGE_SIZE, -(-num_pairs // (4 * max(1, num_workers)))))
+        tasks, function = iter_ranges(num_pairs, range_size), process_tree_pair_range
+    else:
+        pair_index = None
+        range_size = max(1, min(PAIR_RANGE_SIZE, -(-len(tree_pairs) // (4 * max(1, num_workers)))))
+        tasks = (tree_pairs[start:stop] for start, stop in iter_ranges(len(tree_pairs), range_size))
+        function = process_tree_pair_split
+
+    if num_workers:
+        block, layout = cohort.share_relation_matrices()
+        try:
+            with Pool(processes=num_workers, initializer=init_relations_worker,
+                      initargs=(layout, store, pair_index)) as pool:
+                results = list(imap_bounded(pool, function, tasks, 2 * num_workers))
+        finally:
+            block.close()
+            block.unlink()
+    else:
+        # the serial path runs the worker functions on the globals, which are reset so the matrices can be freed
+        global worker_relations, worker_store, worker_pair_index
+        worker_relations, worker_store, worker_pair_index = cohort.relation_matrices(), store, pair_index
+        try:
+            results = [function(task) for task in tasks]
+        finally:
+            worker_relations, worker_store, worker_pair_index = None, None, None
+
+    if results:
+        add_encoded_conflicts(store, tuple(np.concatenate(column) for column in zip(*results)))
+    # the trees of patients collapsed into a weighted tree are common to pairs that are not enumerated
+    weighted = [t for t in range(len(cohort)) if cohort.tree_weights[t] > 1]
+    store.nodes = np.union1d(store.nodes, np.array([v for t in weighted for v in cohort.nodes(t)], dtype=np.int64))
+    if verbose:
+        print(f'Received {sum(column.nbytes for result in results for column in result) / 2 ** 20:.1f} MB of '
+              f'conflict arrays from {len(results)} tasks')
+    return store
+
+
+def get_patient_shared_nodes(cohort: Cohort):
+    # mutations observed in trees of at least two patients are the nodes of the union conflict graph, a weighted tree of
+    # a deduplicated cohort stands for several patients
+    seen, shared = 0, 0
+    for trees, weight in zip(cohort.patient_trees, cohort.patient_weights()):
+        patient_nodes = 0
+        for t in trees:
+            patient_nodes |= cohort.tree_nodes[t]
+        shared |= seen & patient_nodes
+        if weight > 1:
+            shared |= patient_nodes
+        seen |= patient_nodes
+    return shared
+
+
+def get_relation_classes(cohort: Cohort, relations: list=None):
+    """
+    Tally the relation class of every mutation pair (a, b) with a < b over all trees. Returns the mutation pairs encoded
+    as a * number of mutations + b, the relation codes and the trees as arrays sorted by pair, code and tree, together
+    with the start and end of each group of trees per mutation pair and relation class.
+    """
+    if relations is None:
+        relations = cohort.relation_matrices()
+    n = len(cohort.mutations)
+    keys, codes, trees = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.uint8)], [np.zeros(0, dtype=np.int64)]
+    for t, (ids, matrix) in enumerate(relations):
+        upper = np.triu_indices(len(ids), 1)
+        keys.append(ids[upper[0]] * n + ids[upper[1]])
+        codes.append(matrix[upper])
+        trees.append(np.full(len(upper[0]), t, dtype=np.int64))
+    keys, codes, trees = np.concatenate(keys), np.concatenate(codes), np.concatenate(trees)
+    order = np.lexsort((trees, codes, keys))
+    keys, codes, trees = keys[order], codes[order], trees[order]
+
+    change = np.flatnonzero((keys[1:] != keys[:-1]) | (codes[1:] != codes[:-1])) + 1
+    starts = np.concatenate(([0], change)) if len(keys) else change
+    ends = np.concatenate((change, [len(keys)]))
+    return keys, codes, trees, starts, ends
+
+
+def get_conflicting_tree_pairs(trees1: np.ndarray, trees2: np.ndarray, tree_patient: np.ndarray):
+    # all pairs of trees from distinct patients of two relation classes
+    first = np.repeat(trees1, len(trees2))
+    second = np.tile(trees2, len(trees1))
+    distinct = tree_patient[first] != tree_patient[second]
+    return first[distinct], second[distinct]
+
+
+def get_pair_free_conflict_graph(cohort: Cohort, verbose: bool=False):
+    """
+    Union conflict graph and potential conflicts without enumerating the tree pairs. The conflict status of a mutation
+    pair in a pair of trees only depends on the relation classes of the pair in both trees, hence the conflicting tree
+    pairs are the products of the groups of trees per relation class. Same conflicts as
+    get_conflict_graphs_single_thread, but stored in a ConflictStore.
+    """
+    if verbose:
+        print('Create union conflict graph from relation classes')
+
+    store = ConflictStore.from_cohort(cohort, list(iter_bits(get_patient_shared_nodes(cohort))))
+    n = store.num_mutations
+    keys, codes, trees, starts, ends = get_relation_classes(cohort)
+
+    pairs, tree_pairs = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    potential_pairs, potential_tree_pairs, edge_trees = ([np.zeros(0, dtype=np.int64)] for _ in range(3))
+
+    # only mutation pairs in at least two relation classes can be in conflict
+    group_keys = keys[starts]
+    first_group = np.concatenate(([True], group_keys[1:] != group_keys[:-1])) if len(starts) else np.zeros(0, bool)
+    pair_starts = np.flatnonzero(first_group)
+    pair_ends = np.concatenate((pair_starts[1:], [len(starts)]))
+    for s, e in zip(pair_starts[pair_ends - pair_starts > 1], pair_ends[pair_ends - pair_starts > 1]):
+        a, b = divmod(int(group_keys[s]), n)
+        for i, j in itertools.combinations(range(s, e), 2):
+            combined = codes[starts[i]] | codes[starts[j]]
+            if not CONFLICT_CODES[combined] and not combined & CLUSTER:
+                continue
+            first, second = get_conflicting_tree_pairs(trees[starts[i]:ends[i]], trees[starts[j]:ends[j]],
+                                                       store.tree_patient)
+            if CONFLICT_CODES[combined]:
+                pairs.append(np.full(len(first), group_keys[s], dtype=np.int64))
+                tree_pairs.append(store.encode_tree_pairs(first, second))
+            else:
+                # codes are sorted, so the order before / after is observed in the trees of the first class
+                key = a * n + b if combined & BEFORE else b * n + a
+                potential_pairs.append(np.full(len(first), key, dtype=np.int64))
+                potential_tree_pairs.append(store.encode_tree_pairs(first, second))
+                edge_trees.append(first)
+
+    store.set_conflicts(np.concatenate(pairs), np.concatenate(tree_pairs))
+    store.set_potential_conflicts(np.concatenate(potential_pairs), np.concatenate(potential_tree_pairs),
+                                  np.concatenate(edge_trees))
+    return store
+
+
+def add_low_frequency_conflicts(store: ConflictStore):
+    """
+    Same as add_low_frequency_edges_union_graph on a ConflictStore: if both orders a precedes b and b precedes a can
+    resolve a ~ b, only the more frequent order is kept as potential conflict, the other one becomes a conflict.
+    """
+    keys, counts = store.potential_edge_counts()
+    source, target = store.decode_pairs(keys)
+    reverse = target * store.num_mutations + source
+    index = np.minimum(np.searchsorted(keys, reverse), max(len(keys) - 1, 0))
+    both = (keys[index] == reverse) & (keys < reverse) if len(keys) else np.zeros(0, dtype=bool)
+
+    less_frequent = []
+    for key, count, reverse_key, reverse_count in zip(keys[both], counts[both], reverse[both], counts[index[both]]):
+        if count > reverse_count:
+            less_frequent.append(reverse_key)
+        elif reverse_count > count:
+            less_frequent.append(key)
+        else:
+            a, b = divmod(int(key), store.num_mutations)
+            print('Same frequency of edges: ', (store.mutations[a], store.mutations[b]), count,
+                  (store.mutations[b], store.mutations[a]), reverse_count)
+    store.resolve_potential_conflicts(less_frequent)
+    return
+
+
+def add_resolution_threshold_conflicts(store: ConflictStore, threshold: int):
+    # same as add_resolution_threshold_edges on a ConflictStore
+    keys, counts = store.potential_edge_counts()
+    store.resolve_potential_conflicts(keys[counts < threshold])
+    return
+
+
 def collect_potential_conflicts(conflicts: dict, dict_to_update: dict):
     for pcp in conflicts:
         if pcp not in dict_to_update:
@@ -195,8 +517,3 @@ def add_resolution_threshold_edges(union_graph: nx.MultiGraph, potential_conflic
             del potential_conflicts[key]
 
     return
-
-
-
-
-
@@ -1,6 +1,7 @@
 import os
 import argparse
 import networkx as nx
+from cohort import Cohort, iter_bits
 
 
 def get_parser():
@@ -13,39 +14,39 @@ def get_parser():
     return parser
 
 
-def hash_graph(G):
-    tuple_of_edges = tuple(sorted(G.edges))
-    tuple_of_nodes = tuple(sorted(G.nodes))
-    return hash(tuple_of_edges + tuple_of_nodes)
+def canonical_key(G):
+    """
+    Trajectories are labelled DAGs, two of them are the same if their nodes, edges and cluster annotations are equal.
+    """
+    clusters = frozenset((n, c) for n, cluster in G.nodes(data='cluster_nodes') if cluster for c in cluster)
+    return frozenset(G.nodes), frozenset(G.edges), clusters
 
 
 def get_graphs_from_computation(sorted_trajectories):
     rec_traj_graphs = dict()
     for traj in sorted_trajectories:
         graph_name = set(traj.graph.get('name', 'Graph has no name').split(':'))
-        graph_hash = hash_graph(traj)
-        if graph_hash not in rec_traj_graphs:
-            rec_traj_graphs[graph_hash] = [traj, graph_name]
+        key = canonical_key(traj)
+        if key not in rec_traj_graphs:
+            rec_traj_graphs[key] = [traj, graph_name]
         else:
-            rec_traj_graphs[graph_hash][1].update(graph_name)
+            rec_traj_graphs[key][1].update(graph_name)
     return rec_traj_graphs
 
 
-def compute_support(trajectories: list, input_graphs: dict, output_dir: str):
+def compute_support(trajectories: list, cohort: Cohort, output_dir: str):
+    """
+    Write the support of the trajectories to processed_graphs/processed_graphs_support.csv. Returns the file and its rows
+    (support, supporting graph names, edges) to pass them on without reading the file.
+    """
     sorted_graphs = sorted(trajectories, key=lambda n: n.number_of_nodes(), reverse=True)
     rec_traj_graphs = get_graphs_from_computation(sorted_graphs)
 
-    # iterate over all input graphs in check for any of the trajectories
-    for patient in input_graphs:
-        for G in input_graphs[patient]:
-            graph_ = nx.transitive_closure_dag(G)
-            for key, val in rec_traj_graphs.items():
-                traj, graph_names = val
-                traj = nx.transitive_closure_dag(traj)
-                sub_g = graph_.subgraph(traj.nodes).copy()
-                if sub_g.edges == traj.edges:
-                    name = G.graph.get('name', 'Graph has no name')
-                    rec_traj_graphs[key][1].add(name)
+    # input graphs supporting a trajectory are found with the inverted index of the cohort instead of comparing subgraphs
+    for key, val in rec_traj_graphs.items():
+        traj, graph_names = val
+        supporting = cohort.supporting_trees(traj.nodes, traj.edges)
+        graph_names.update(cohort.tree_names[t] for t in iter_bits(supporting))
 
     dir = os.path.join(output_dir, 'processed_graphs/')
     if not os.path.isdir(dir):
@@ -54,6 +55,7 @@ def compute_support(trajectories: list, input_graphs: dict, output_dir: str):
     file_name = dir + '/processed_graphs_support.csv'
     file_info = open(file_name, 'w')
     file_info.write('File Index,Support,Supporting Graphs,Edges\n')
+    rows = []
     i = 1
     for key, val in rec_traj_graphs.items():
         G, graph_names = val
@@ -78,6 +80,8 @@ def compute_support(trajectories: list, input_graphs: dict, output_dir: str):
             #print(str(i) + ',' + str(count) + ',' + ' '.join(graph_names) + ',')
             file_info.write(str(i) + ',' + str(count) + ',' + ' '.join(graph_names) + ',')
             file_info.write(' '.join([f'{edge}' for edge in edges]) + '\n')
+            rows.append((count, graph_names, list(edges)))
             i += 1
+    file_info.close()
 
-    return file_name
\ No newline at end of file
+    return file_name, rows
\ No newline at end of file
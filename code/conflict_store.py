@@ -0,0 +1,167 @@
+# ---------------------------------------------------------------------------- #
+#                                    IMPORTS                                   #
+# ---------------------------------------------------------------------------- #
+import numpy as np
+import networkx as nx
+
+
+# ---------------------------------------------------------------------------- #
+#                                   FUNCTIONS                                  #
+# ---------------------------------------------------------------------------- #
+def unique_rows(*columns):
+    # sort integer columns lexicographically (first column first) and drop duplicated rows
+    columns = [np.asarray(c, dtype=np.int64) for c in columns]
+    if len(columns[0]) == 0:
+        return columns
+    order = np.lexsort(columns[::-1])
+    columns = [c[order] for c in columns]
+    keep = np.ones(len(columns[0]), dtype=bool)
+    keep[1:] = np.any([c[1:] != c[:-1] for c in columns], axis=0)
+    return [c[keep] for c in columns]
+
+
+class ConflictStore:
+    """
+    Union conflict graph as sorted integer arrays: tree pairs t1 * number of trees + t2 in CSR form over mutation
+    pairs a * number of mutations + b (a < b); potential conflicts as directed mutation and tree pairs with the tree
+    of the order.
+    """
+
+    def __init__(self, mutations: list, tree_names: list, tree_patient, nodes=(), tree_copies=None):
+        self.mutations = list(mutations)
+        self.tree_names = list(tree_names)
+        self.tree_patient = np.asarray(tree_patient, dtype=np.int64)
+        # number of input trees each tree stands for in a deduplicated cohort
+        self.tree_copies = np.ones(len(self.tree_names), dtype=np.int64) if tree_copies is None else \
+            np.asarray(tree_copies, dtype=np.int64)
+        self.nodes = np.unique(np.asarray(nodes, dtype=np.int64))
+        self.set_conflicts([], [])
+        self.set_potential_conflicts([], [], [])
+
+    @classmethod
+    def from_cohort(cls, cohort, nodes=()):
+        return cls(cohort.mutations, cohort.tree_names, cohort.tree_patient, nodes, cohort.tree_copies)
+
+    @property
+    def num_mutations(self):
+        return len(self.mutations)
+
+    @property
+    def num_trees(self):
+        return len(self.tree_names)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def encode_pairs(self, a, b):
+        a, b = np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)
+        return np.minimum(a, b) * self.num_mutations + np.maximum(a, b)
+
+    def decode_pairs(self, pairs):
+        return np.divmod(np.asarray(pairs, dtype=np.int64), self.num_mutations)
+
+    def encode_tree_pairs(self, t1, t2):
+        t1, t2 = np.asarray(t1, dtype=np.int64), np.asarray(t2, dtype=np.int64)
+        swap = self.tree_patient[t1] > self.tree_patient[t2]
+        return np.where(swap, t2, t1) * self.num_trees + np.where(swap, t1, t2)
+
+    def decode_tree_pairs(self, tree_pairs):
+        return np.divmod(np.asarray(tree_pairs, dtype=np.int64), self.num_trees)
+
+    def set_conflicts(self, pairs, tree_pairs):
+        self.pairs, self.tree_pairs = unique_rows(pairs, tree_pairs)
+        # CSR index: conflicts of pair_keys[i] are stored in [pair_indptr[i], pair_indptr[i + 1])
+        self.pair_keys, starts = np.unique(self.pairs, return_index=True)
+        self.pair_indptr = np.append(starts, len(self.pairs)).astype(np.int64)
+
+    def set_potential_conflicts(self, pairs, tree_pairs, edge_trees):
+        self.potential_pairs, self.potential_tree_pairs, self.potential_edge_trees = unique_rows(pairs, tree_pairs,
+                                                                                                 edge_trees)
+
+    def add_conflicts(self, pairs, tree_pairs):
+        self.set_conflicts(np.concatenate((self.pairs, np.asarray(pairs, dtype=np.int64))),
+                           np.concatenate((self.tree_pairs, np.asarray(tree_pairs, dtype=np.int64))))
+
+    def add_potential_conflicts(self, pairs, tree_pairs, edge_trees):
+        self.set_potential_conflicts(
+            np.concatenate((self.potential_pairs, np.asarray(pairs, dtype=np.int64))),
+            np.concatenate((self.potential_tree_pairs, np.asarray(tree_pairs, dtype=np.int64))),
+            np.concatenate((self.potential_edge_trees, np.asarray(edge_trees, dtype=np.int64))))
+
+    def merge(self, other):
+        # stores of parallel workers only differ in their conflicts, so merging is a concatenation
+        merged = ConflictStore(self.mutations, self.tree_names, self.tree_patient,
+                               np.concatenate((self.nodes, other.nodes)), self.tree_copies)
+        merged.set_conflicts(np.concatenate((self.pairs, other.pairs)),
+                             np.concatenate((self.tree_pairs, other.tree_pairs)))
+        merged.set_potential_conflicts(np.concatenate((self.potential_pairs, other.potential_pairs)),
+                                       np.concatenate((self.potential_tree_pairs, other.potential_tree_pairs)),
+                                       np.concatenate((self.potential_edge_trees, other.potential_edge_trees)))
+        return merged
+
+    def lookup(self, a: int, b: int):
+        # tree pairs in which the mutations a and b are in conflict
+        key = int(self.encode_pairs(a, b))
+        i = np.searchsorted(self.pair_keys, key)
+        if i == len(self.pair_keys) or self.pair_keys[i] != key:
+            return self.tree_pairs[:0]
+        return self.tree_pairs[self.pair_indptr[i]:self.pair_indptr[i + 1]]
+
+    def conflicts(self):
+        # all conflicts as arrays of mutation ids a < b and trees t1, t2
+        a, b = self.decode_pairs(self.pairs)
+        t1, t2 = self.decode_tree_pairs(self.tree_pairs)
+        return a, b, t1, t2
+
+    def potential_edge_counts(self):
+        # number of distinct input trees observing the order of each directed mutation pair of the potential conflicts
+        pairs, edge_trees = unique_rows(self.potential_pairs, self.potential_edge_trees)
+        keys, inverse = np.unique(pairs, return_inverse=True)
+        return keys, np.bincount(inverse, weights=self.tree_copies[edge_trees], minlength=len(keys)).astype(np.int64)
+
+    def resolve_potential_conflicts(self, directed_pairs):
+        # potential conflicts of the given directed mutation pairs are not resolved but become conflicts
+        selected = np.isin(self.potential_pairs, directed_pairs)
+        source, target = self.decode_pairs(self.potential_pairs[selected])
+        self.add_conflicts(self.encode_pairs(source, target), self.potential_tree_pairs[selected])
+        self.set_potential_conflicts(self.potential_pairs[~selected], self.potential_tree_pairs[~selected],
+                                     self.potential_edge_trees[~selected])
+
+    def save(self, file_name: str):
+        np.savez_compressed(file_name, mutations=np.array(self.mutations, dtype=str),
+                            tree_names=np.array(self.tree_names, dtype=str), tree_patient=self.tree_patient,
+                            tree_copies=self.tree_copies,
+                            nodes=self.nodes, pairs=self.pairs, tree_pairs=self.tree_pairs,
+                            potential_pairs=self.potential_pairs, potential_tree_pairs=self.potential_tree_pairs,
+                            potential_edge_trees=self.potential_edge_trees)
+
+    @classmethod
+    def load(cls, file_name: str):
+        with np.load(file_name) as data:
+            store = cls(data['mutations'].tolist(), data['tree_names'].tolist(), data['tree_patient'], data['nodes'],
+                        data['tree_copies'])
+            store.set_conflicts(data['pairs'], data['tree_pairs'])
+            store.set_potential_conflicts(data['potential_pairs'], data['potential_tree_pairs'],
+                                          data['potential_edge_trees'])
+        return store
+
+    def to_multigraph(self):
+        # labelled networkx view as created by get_conflict_graphs_single_thread, e.g. for debugging
+        union_graph = nx.MultiGraph()
+        union_graph.add_nodes_from(self.mutations[v] for v in self.nodes)
+        for a, b, t1, t2 in zip(*self.conflicts()):
+            union_graph.add_edge(self.mutations[a], self.mutations[b],
+                                 label=self.tree_names[t1] + ':' + self.tree_names[t2])
+        return union_graph
+
+    def to_potential_conflicts_dict(self):
+        potential_conflicts = dict()
+        source, target = self.decode_pairs(self.potential_pairs)
+        t1, t2 = self.decode_tree_pairs(self.potential_tree_pairs)
+        for a, b, g1, g2, edge_tree in zip(source, target, t1, t2, self.potential_edge_trees):
+            key = (self.mutations[a], self.mutations[b])
+            if key not in potential_conflicts:
+                potential_conflicts[key] = {'labels': set(), 'edge_graph_names': set()}
+            potential_conflicts[key]['labels'].add(':'.join(sorted([self.tree_names[g1], self.tree_names[g2]])))
+            potential_conflicts[key]['edge_graph_names'].add(self.tree_names[edge_tree])
+        return potential_conflicts
@@ -26,6 +26,24 @@ def convert(input_file, dir):
     return output
 
 
+def convert_rows(rows: list, dir: str):
+    """
+    Same as convert for the rows returned by compute_support, without reading the csv file. Returns the output file and
+    the converted rows (edges, support, supporting graph names) as read by the significance test.
+    """
+    output = dir + '/converted_graphs.txt'
+    converted = []
+    with open(output, 'w') as file:
+        for support, supporting_graphs, edges in rows:
+            edges = ' '.join(edges)
+            supporting_graphs = ' '.join(supporting_graphs).replace('L', '')
+
+            file.write(edges + ' (' + str(support) + ')\n')
+            file.write(supporting_graphs + '\n')
+            converted.append((edges, support, supporting_graphs.split(' ')))
+    return output, converted
+
+
 if __name__ == '__main__':
     args = get_parser().parse_args()
     convert(args.input, dir)
@@ -1,7 +1,9 @@
 import os
+import xml.etree.ElementTree as ET
 import networkx as nx
 from multiprocessing import Pool
 from collections.abc import Iterable
+from cohort import Cohort
 
 
 def add_attributes(node1, node2, graph):
@@ -16,34 +18,60 @@ def add_attributes(node1, node2, graph):
         graph.add_node(node1, cluster_nodes={node2})
 
 
-def get_graph_from_line(read_line, name):
-    graph = nx.DiGraph()
-    graph.add_node('0')
-
+def cluster_attributes(cluster_pairs: list):
+    # cluster_nodes attributes left by add_attributes for the cluster pairs in the order of the line
+    cluster_nodes = dict()
+    for a, b in cluster_pairs:
+        for node1, node2 in ((a, b), (b, a)):
+            if node1 in cluster_nodes:
+                for n in cluster_nodes[node1]:
+                    if n == node1 or n == node2:
+                        continue
+                    cluster_nodes[n].add(node2)
+                cluster_nodes[node1].add(node2)
+            else:
+                cluster_nodes[node1] = {node2}
+    return cluster_nodes
+
+
+def parse_line(read_line, name):
+    # split a line into the tree name, all nodes in order of appearance, directed edges and cluster_nodes attributes
     split_line = read_line.strip('\n').strip().split(',')
     if len(split_line) == 2:
-        graph.name = split_line[0]
+        name = split_line[0]
         line = split_line[1].split(' ')
     else:
-        graph.name = str(name)
+        name = str(name)
         line = read_line.strip('\n').strip().split(' ')
 
+    nodes, edges, cluster_pairs = dict(), [], []
     for i, e in enumerate(line):
         # _ is special character for us
         if e.__contains__('->-'):
-            a, b = e.split('->-')
-            graph.add_edge(a, b)
+            edges.append(tuple(e.split('->-')))
+            nodes.update(dict.fromkeys(edges[-1]))
         elif e.__contains__('-?-'):
-            a, b = e.split('-?-')
-            # mark nodes as nodes from the same cluster
-            add_attributes(a, b, graph)
-            add_attributes(b, a, graph)
+            cluster_pairs.append(tuple(e.split('-?-')))
+            nodes.update(dict.fromkeys(cluster_pairs[-1]))
         elif e.__contains__('-/-'):
-            a, b = e.split('-/-')
-            graph.add_nodes_from([a, b])
+            nodes.update(dict.fromkeys(e.split('-/-')))
         else:
             # e must be a single node instead of an edge
-            graph.add_node(e)
+            nodes[e] = None
+
+    return name, list(nodes), edges, cluster_attributes(cluster_pairs)
+
+
+def get_graph_from_line(read_line, name):
+    graph = nx.DiGraph()
+    graph.add_node('0')
+
+    graph.name, nodes, edges, cluster_nodes = parse_line(read_line, name)
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(edges)
+    for node, cluster in cluster_nodes.items():
+        # mark nodes as nodes from the same cluster
+        graph.nodes[node]['cluster_nodes'] = cluster
 
     for node in graph.nodes:
         if node == '0':
@@ -66,7 +94,52 @@ def process_split(split: Iterable):
     return evol_id, graph
 
 
-def get_graphs_parallel(trees_to_build: list, num_workers: int=os.cpu_count()):
+def parse_gexf(gexf_file: str):
+    """
+    Stream a gexf file with iterparse into its node ids, directed edges and cluster_nodes attributes (node id -> list of
+    nodes in its cluster), without building a networkx graph. Elements are cleared once they are read.
+    """
+    nodes, edges, clusters = [], [], dict()
+    cluster_attribute = None
+    for _, elem in ET.iterparse(gexf_file, events=('end',)):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag == 'attribute' and elem.get('title') == 'cluster_nodes':
+            cluster_attribute = elem.get('id')
+        elif tag == 'node':
+            nodes.append(elem.get('id'))
+            for value in elem.iter():
+                if value.tag.rsplit('}', 1)[-1] == 'attvalue' and value.get('for') == cluster_attribute:
+                    val = value.get('value')
+                    clusters[nodes[-1]] = val.split(',') if val else []
+            elem.clear()
+        elif tag == 'edge':
+            edges.append((elem.get('source'), elem.get('target')))
+            elem.clear()
+    return nodes, edges, clusters
+
+
+def get_graph_from_gexf(gexf_file: str, name):
+    # same graph as get_graph_from_line for a gexf file, cluster_nodes are kept as given in the file
+    nodes, edges, clusters = parse_gexf(gexf_file)
+    graph = nx.DiGraph()
+    graph.add_node('0')
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(edges)
+    for node, cluster in clusters.items():
+        graph.nodes[node]['cluster_nodes'] = set(cluster)
+    graph.add_edges_from([('0', node) for node in graph.nodes if node != '0'])
+    graph = nx.transitive_closure_dag(graph)
+    graph.name = str(name)
+    return graph
+
+
+def process_gexf(split: Iterable):
+    evol_id, phylo_tree, gexf_file = split
+    return evol_id, get_graph_from_gexf(gexf_file, phylo_tree)
+
+
+def get_graphs_parallel(trees_to_build: list, num_workers: int=os.cpu_count(), gexf_files: list=()):
+    # gexf files are given as (evolution id, tree name, file) and read by the same workers as the lines
     graphs = {x[0]: [] for x in trees_to_build}
     split_size = max(1, len(graphs) // num_workers)
 
@@ -74,11 +147,43 @@ def get_graphs_parallel(trees_to_build: list, num_workers: int=os.cpu_count()):
         for evol_id, graph in pool.imap_unordered(process_split, trees_to_build, chunksize=split_size):
             if graph:
                 graphs[evol_id].append(graph)
+        for evol_id, graph in pool.imap(process_gexf, gexf_files, chunksize=max(1, len(gexf_files) // (4 * num_workers))):
+            graphs.setdefault(evol_id, []).append(graph)
 
     print(len(graphs), sum([len(graphs[i]) for i in graphs]))
     return graphs
 
 
+def process_split_compact(split: Iterable):
+    evol_id, phylo_tree, line = split
+    return (evol_id,) + parse_line(line, phylo_tree)
+
+
+def process_gexf_compact(split: Iterable):
+    evol_id, phylo_tree, gexf_file = split
+    nodes, edges, clusters = parse_gexf(gexf_file)
+    return evol_id, str(phylo_tree), nodes, edges, clusters
+
+
+def get_cohort_parallel(trees_to_build: list, num_workers: int=os.cpu_count(), cohort: Cohort=None,
+                        gexf_files: list=()):
+    # lines and gexf files are only parsed by the workers, interning and closure of the trees is done by the cohort
+    if cohort is None:
+        cohort = Cohort()
+    num_workers = max(1, num_workers)
+    split_size = max(1, len(trees_to_build) // num_workers)
+
+    with Pool(processes=num_workers) as pool:
+        for evol_id, name, nodes, edges, cluster_nodes in pool.imap(process_split_compact, trees_to_build,
+                                                                     chunksize=split_size):
+            cohort.add_tree(evol_id, name, nodes, edges, cluster_nodes)
+        for evol_id, name, nodes, edges, cluster_nodes in pool.imap(process_gexf_compact, gexf_files,
+                                                                     chunksize=max(1, len(gexf_files) // (4 * num_workers))):
+            cohort.add_tree(evol_id, name, nodes, edges, cluster_nodes)
+
+    return cohort
+
+
 def get_graphs_single_thread(lines: list, names: list, verbose: bool=False):
     if verbose:
         print('Start single threaded computation of graphs')
@@ -7,13 +7,12 @@ import pickle
 import re
 
 import pandas as pd
-import networkx as nx
-from create_graphs import get_graphs_parallel, get_graphs_single_thread
+from create_graphs import get_graphs_parallel, get_graphs_single_thread, get_cohort_parallel
 
 # ---------------------------------------------------------------------------- #
 #                               GLOBAL VARIABLES                               #
 # ---------------------------------------------------------------------------- #
-verbose: bool
+verbose: bool = False
 
 
 # ---------------------------------------------------------------------------- #
@@ -37,16 +36,17 @@ def file_name_match(file_name):
     return evolution, phylo_tree
 
 
-def read_multiple_graphs_per_evolution(path: str, out: str, parallel_processes: int, verbose_flag: bool=False):
-    global verbose
-    verbose = verbose_flag
-
+def collect_input_trees(path: str):
+    """
+    Collect the lines of all trees to build as triplets of evolution id, tree name and line together with the gexf files
+    and their evolution id and tree name.
+    """
     if not os.path.isdir(path) and not os.path.isfile(path):
         print('Please provide an existing folder to input trees')
         exit(-1)
 
-    log('Start iterating over multiple input trees for each evolution')
     evol_processes = [] # triplet list with id, tree number and the read in line
+    gexf_files = []
 
     '''
     if provided a single txt file, each line is assumed to be a distinct evolutionary process, 
@@ -56,7 +56,6 @@ def read_multiple_graphs_per_evolution(path: str, out: str, parallel_processes:
         with open(path) as f:
             for i, line in enumerate(f):
                 evol_processes.append((str(i), str(i) + '-0', line))
-        graphs = get_graphs_parallel(evol_processes, parallel_processes)
     else:
         filelist = glob.glob(path + '/*.txt')
         for file in sorted(filelist):
@@ -76,36 +75,52 @@ def read_multiple_graphs_per_evolution(path: str, out: str, parallel_processes:
                         evol_processes.append((evolution, phylo_tree, sorted_line))
                         tmp_duplicates[sorted_line] = None
 
-        graphs = get_graphs_parallel(evol_processes, parallel_processes)
-
         # allow for graphs in gexf format
         gexflist = glob.glob(path + '/*.gexf')
         for gexf_file in gexflist:
             file_name = gexf_file.split('/')[-1]
             evolution, phylo_tree = file_name_match(file_name)
-            # read in graph from gexf file
-            graph = nx.read_gexf(gexf_file)
-
-            for n, data in graph.nodes(data=True):
-                if 'cluster_nodes' in data:
-                    val = data.get('cluster_nodes')
-                    data['cluster_nodes'] = set(val.split(',')) if val else set()
-
-            # add root node and connect it to all other nodes
-            graph.add_node('0')
-            graph.add_edges_from([('0', node) for node in graph.nodes if node != '0'])
-            graph = nx.transitive_closure_dag(graph)
-            graph.name = str(phylo_tree)
-            if evolution in graphs:
-                graphs[evolution].append(graph)
-            else:
-                graphs[evolution] = [graph]
+            gexf_files.append((evolution, phylo_tree, gexf_file))
+
+    return evol_processes, gexf_files
+
+
+def write_trees_per_patient(id_tree_pairs: list, out: str):
+    df = pd.DataFrame(id_tree_pairs, columns=['evolution', 'distinct trees'])
+    df.to_csv(out + '/number_of_distinct_trees_per_patient.csv')
+    num = sum([pair[1] for pair in id_tree_pairs])
+    log('Number of graphs read from input: ' + str(num))
+
+
+def read_multiple_graphs_per_evolution(path: str, out: str, parallel_processes: int, verbose_flag: bool=False):
+    global verbose
+    verbose = verbose_flag
+
+    log('Start iterating over multiple input trees for each evolution')
+    evol_processes, gexf_files = collect_input_trees(path)
+    # gexf files are streamed by the same worker pool as the lines
+    graphs = get_graphs_parallel(evol_processes, parallel_processes, gexf_files)
+
+    if verbose:
+        write_trees_per_patient([(e, len(trees)) for e, trees in graphs.items()], out)
+
+    return graphs
+
+
+def read_cohort(path: str, out: str, parallel_processes: int, verbose_flag: bool=False):
+    """
+    Same input handling as read_multiple_graphs_per_evolution, but the trees are stored in a compact Cohort instead of
+    one networkx graph per tree.
+    """
+    global verbose
+    verbose = verbose_flag
+
+    log('Start iterating over multiple input trees for each evolution')
+    evol_processes, gexf_files = collect_input_trees(path)
+    cohort = get_cohort_parallel(evol_processes, parallel_processes, gexf_files=gexf_files)
+    log(f'Read {len(cohort)} trees of {len(cohort.patients)} patients')
 
     if verbose:
-        id_tree_pairs = [(e, len(trees)) for e, trees in graphs.items()]
-        df = pd.DataFrame(id_tree_pairs, columns=['evolution', 'distinct trees'])
-        df.to_csv(out + '/number_of_distinct_trees_per_patient.csv')
-        num = sum([pair[1] for pair in id_tree_pairs])
-        log('Number of graphs read from input: ' + str(num))
+        write_trees_per_patient([(e, len(trees)) for e, trees in zip(cohort.patients, cohort.patient_trees)], out)
 
-    return graphs
\ No newline at end of file
+    return cohort
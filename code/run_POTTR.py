@@ -3,13 +3,19 @@
 #                                    IMPORTS                                   #
 # ---------------------------------------------------------------------------- #
 import os
+import time
 import argparse
 import itertools
 import POTTR
+import solver_highs
+import solver_bnb
+import solver_heuristic
+import cache
 import compute_support
 import convert_to_mastro_format
 import networkx as nx
-from read_input_dags import read_multiple_graphs_per_evolution
+from cohort import Cohort
+from read_input_dags import read_cohort, write_trees_per_patient
 from create_graphs import add_attributes, get_graphs_parallel, get_graphs_single_thread
 from compute_conflict_graph import *
 from MASTRO_significance_test import compute_significance
@@ -32,8 +38,11 @@ def get_parser():
                         help='Path to store output files')
     parser.add_argument('--dags', '-d', required=True, dest='dags', type=str,
                         help='File or directory containing transitively closed DAGs (incomplete posets)')
-    parser.add_argument('--k', '-k', required=True, dest='k', type=int,
+    parser.add_argument('--k', '-k', dest='k', type=int,
                         help='Number k of incomplete posets to search for common trajectory')
+    parser.add_argument('--k-range', '-kr', dest='k_range', type=int, nargs=2, metavar=('K_MIN', 'K_MAX'),
+                        help='Search trajectories for all k from K_MIN to K_MAX with one model, results are written to '
+                             'the folders out_k<k> of the output path')
     parser.add_argument('--resolution_threshold', '-rt', dest='resolution_threshold', type=int,
                         help='Number of edges required to resolve a cluster')
     parser.add_argument('--resolution_frequency', '-rf', action='store_true',
@@ -44,6 +53,35 @@ def get_parser():
                         help='Enable parallel processing')
     parser.add_argument('--solution-pool-size', '-pool', default=0, dest='pool_size', type=int,
                         help='Solution pool size for Gurobi to retrieve multiple solutions')
+    parser.add_argument('--solver', '-solver', default='gurobi', dest='solver', choices=['gurobi', 'highs', 'bnb'],
+                        help='MILP solver, Gurobi (default) or HiGHS via scipy, which needs no license, or a branch and '
+                             'bound over node sets for small numbers of mutations')
+    parser.add_argument('--enumerate', '-enum', action='store_true', dest='enumerate_all',
+                        help='Enumerate all maximum trajectories with no-good cuts instead of one large solution pool; '
+                             '-pool is the number of solutions collected per solve (default 10)')
+    parser.add_argument('--heuristic', '-heuristic', action='store_true', dest='heuristic',
+                        help='Only compute a heuristic trajectory (greedy tree sets and independent set), e.g. for a '
+                             'quick look at huge cohorts; the trajectory is not necessarily maximum')
+    parser.add_argument('--no-mip-start', '-no-mip-start', action='store_false', dest='mip_start',
+                        help='Do not start Gurobi from the heuristic trajectory')
+    parser.add_argument('--model-builder', '-builder', default='matrix', dest='builder', choices=['matrix', 'loop'],
+                        help='Build the ILP with the Gurobi matrix API (default) or variable by variable')
+    parser.add_argument('--model-names', '-names', action='store_true', dest='model_names',
+                        help='Name all variables and constraints of the matrix ILP, e.g. for debugging')
+    parser.add_argument('--no-presolve', '-no-presolve', action='store_false', dest='presolve',
+                        help='Build the full matrix ILP without removing nodes and graphs that cannot be selected')
+    parser.add_argument('--significance-max-nodes', '-sig-max', default=13, dest='significance_max_nodes', type=int,
+                        help='Only run the significance test for trajectories with fewer nodes, including the root; '
+                             '0 for no limit')
+    parser.add_argument('--cache-dir', '-cache', nargs='?', const=cache.DEFAULT_CACHE_DIR, dest='cache_dir', type=str,
+                        help='Cache parsed trees, conflict graphs and significance test counts of inputs in this '
+                             f'directory ({cache.DEFAULT_CACHE_DIR} if no directory is given); no cache by default')
+    parser.add_argument('--clear-cache', '-clear-cache', action='store_true', dest='clear_cache',
+                        help='Remove all cached inputs before the run')
+    parser.add_argument('--cache-max-size', default=2048, dest='cache_max_size', type=float,
+                        help='Maximal size of the cache in MB; least recently used inputs are evicted first')
+    parser.add_argument('--cache-max-age', default=30, dest='cache_max_age', type=float,
+                        help='Number of days after which unused cached inputs are evicted')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Increase output verbosity')
     parser.add_argument('--draw_dots', '-dots', action='store_true',
@@ -56,46 +94,47 @@ def log(string):
         print(string)
 
 
-def label_match(G1, G2):
-    if set(G1.nodes) != set(G2.nodes):
-        return False
-
-    if set(G1.edges) != set(G2.edges):
-        return False
-
-    return True
-
-
 def filter_duplicates(trajectories):
     """
     ILP might return the same trajectory multiple times but with a different graph selection. Filter out duplicated
     trajectories and join the selected graphs in one output.
     This might cause a combination of trajectories found in multiple trees of the same patient.
     """
+    # one pass over the canonical keys also used by compute_support, the first occurrence is kept
+    unique = dict()
+    for G in trajectories:
+        key = compute_support.canonical_key(G)
+        if key not in unique:
+            unique[key] = G
+            continue
+        first = unique[key]
+        names = first.graph.get('name').split(':')
+        first.name = ':'.join(names + [n for n in G.graph.get('name').split(':') if n not in names])
 
-    indices_to_remove = []
-    for i, G in enumerate(trajectories):
-        for j in range(i+1, len(trajectories)):
-            # check if graph j is the same as G, if so, remove it
-            if nx.is_isomorphic(G, trajectories[j]) and label_match(G, trajectories[j]):
-                indices_to_remove.append(j)
-                G_name = G.graph.get('name').split(':')
-                traj_name = trajectories[j].graph.get('name').split(':')
-                new_name = list(set(G_name) | set(traj_name))
-                new_name = ':'.join(new_name)
-                G.name = new_name
-
-    print('Number of duplicates', len(indices_to_remove))
-    unique_trajectories = []
-    for i, tra in enumerate(trajectories):
-        if i not in indices_to_remove:
-            unique_trajectories.append(tra)
-
-    return unique_trajectories
+    print('Number of duplicates', len(trajectories) - len(unique))
+    return list(unique.values())
 
 
 def main():
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.k is None and args.k_range is None:
+        parser.error('one of the arguments --k/-k --k-range/-kr is required')
+    if args.k_range and args.k_range[0] > args.k_range[1]:
+        parser.error('K_MIN of --k-range/-kr must not be larger than K_MAX')
+    if args.k_range and args.k_range[1] < 1:
+        parser.error('K_MAX of --k-range/-kr must be at least 1')
+    if args.solver != 'gurobi':
+        # the other solvers neither have a solution pool nor a MIP start nor a Gurobi model
+        gurobi_only = [flag for flag, given in [('--enumerate/-enum', args.enumerate_all),
+                                                ('--solution-pool-size/-pool', args.pool_size > 0),
+                                                ('--no-mip-start/-no-mip-start', not args.mip_start),
+                                                ('--model-builder/-builder', args.builder != 'matrix'),
+                                                ('--model-names/-names', args.model_names)] if given]
+        if gurobi_only:
+            parser.error(f'Gurobi options {", ".join(gurobi_only)} are not supported by --solver {args.solver}')
+    if args.clear_cache and args.cache_dir is None:
+        parser.error('--clear-cache/-clear-cache requires --cache-dir/-cache')
     global verbose
     verbose = args.verbose
 
@@ -111,44 +150,109 @@ def main():
     dags = args.dags
     log(f'Reading dags {dags}')
 
-    # graphs will be transformed into a dict of graphs
-    graphs_dict = read_multiple_graphs_per_evolution(path=dags, out=directory,
-                                                     parallel_processes=args.cores, verbose_flag=verbose)
-    # since graphs is a dictionary, the graph pairs for the conflict computation must be computed from the dict values
-    graph_pairs = []
-    for p1, p2 in itertools.combinations(graphs_dict.keys(), 2):
-        for g1, g2 in itertools.product(graphs_dict[p1], graphs_dict[p2]):
-            graph_pairs.append([g1, g2])
+    # parsed trees and the union conflict graph only depend on the input files and are cached by their content if a
+    # cache directory is given
+    if args.clear_cache:
+        cache.clear(args.cache_dir)
+    cached = None
+    count_cache = ''
+    if args.cache_dir:
+        cache_key = cache.input_key(dags)
+        cached = cache.load(args.cache_dir, cache_key)
+        # counts of the significance test are stored with the entry of the input and reused by later runs
+        count_cache = os.path.join(args.cache_dir, cache_key, 'shape_counts.pkl')
+
+    if cached:
+        cohort, conflicts = cached
+        if verbose:
+            write_trees_per_patient(list(zip(cohort.patients, map(len, cohort.patient_trees))), directory)
+    else:
+        # trees are interned into a compact cohort
+        cohort = read_cohort(path=dags, out=directory, parallel_processes=args.cores, verbose_flag=verbose)
+
+    # identical closed posets are collapsed into one weighted tree for the conflict graph and the ILP, selected trees
+    # are expanded to the input trees again before the output
+    distinct, members = cohort.deduplicate()
+    log(f'{len(distinct)} distinct posets of {len(cohort)} graphs')
+
+    if not cached:
+        # create union conflict graph; without parallelization, the conflicting tree pairs are derived from the
+        # relation classes of each mutation pair instead of enumerating all tree pairs
+        if parallel:
+            log('Create pairwise conflict graphs parallel')
+            conflicts = get_cohort_conflict_graph(distinct, verbose=verbose, num_workers=args.cores)
+        else:
+            conflicts = get_pair_free_conflict_graph(distinct, verbose=verbose)
+        if args.cache_dir:
+            cache.store(args.cache_dir, cache_key, cohort, conflicts, args.cache_max_size, args.cache_max_age)
 
+    # the dict of graphs is the networkx view of the cohort
+    graphs = cohort.to_graphs()
+    graphs_dict = cohort.to_graphs_dict(graphs)
     k = args.k
-    if len(graphs_dict) < k:
+    if k is not None and len(graphs_dict) < k:
         print(f'Value of k is larger than number of patients, set k to maximum value of {len(graphs_dict)}')
         k = len(graphs_dict)
-
-    # create union conflict graph
-    if parallel:
-        log('Create pairwise conflict graphs parallel')
-        pairwise_conflict_graphs, potential_conflicts = get_conflict_graphs_parallel(graph_pairs=graph_pairs, verbose=verbose, num_workers=args.cores)
-        log('Compute union conflict graph')
-        union_graph = get_union_conflict_graph(pairwise_conflict_graphs=pairwise_conflict_graphs, verbose=verbose)
-    else:
-        union_graph, potential_conflicts = get_conflict_graphs_single_thread(graph_pairs=graph_pairs, verbose=verbose)
+    k_range = args.k_range
+    if k_range and len(graphs_dict) < k_range[0]:
+        print(f'K_MIN is larger than number of patients, set K_MIN to maximum value of {len(graphs_dict)}')
+        k_range = [len(graphs_dict), k_range[1]]
 
     # add edges if certain clusters should not be resolved, e.g. if confidence of resolution is too low
     if args.resolution_frequency:
-        add_low_frequency_edges_union_graph(union_graph, potential_conflicts)
+        add_low_frequency_conflicts(conflicts)
     if args.resolution_threshold:
-        add_resolution_threshold_edges(union_graph, potential_conflicts, args.resolution_threshold)
+        add_resolution_threshold_conflicts(conflicts, args.resolution_threshold)
     log('Done creating conflict graph')
 
     log('Start ILP')
-    node_selection_list, graph_selection_list = POTTR.find_max_k_common_trajectory(union_conflict_graph=union_graph,
-                                                                                   input_graphs=graphs_dict,
-                                                                                   k=k,
-                                                                                   cores=args.cores,
-                                                                                   solution_pool_size=args.pool_size,
-                                                                                   verbose=verbose)
-
+    solver = {'gurobi': POTTR, 'highs': solver_highs, 'bnb': solver_bnb}[args.solver]
+    if args.heuristic:
+        solver = solver_heuristic
+    ilp_args = dict(conflicts=conflicts, cohort=distinct, cores=args.cores, solution_pool_size=args.pool_size,
+                    verbose=verbose, builder=args.builder, names=args.model_names, presolve=args.presolve)
+    k_values = range(max(1, k_range[0]), min(k_range[1], len(graphs_dict)) + 1) if k_range else [k]
+
+    # Gurobi starts from the heuristic trajectory of the largest k, which is feasible for all smaller k
+    # enumerated trajectories are written to enumerated_trajectories.txt as soon as they are found
+    if solver is POTTR and args.enumerate_all:
+        def stream_file(k_value):
+            k_directory = os.path.join(directory, f'out_k{k_value}')
+            os.makedirs(k_directory, exist_ok=True)
+            return os.path.join(k_directory, 'enumerated_trajectories.txt')
+
+        ilp_args.update(enumerate_all=True, solution_pool_size=args.pool_size or 10,
+                        stream_file=stream_file if args.k_range else os.path.join(directory, 'enumerated_trajectories.txt'))
+
+    if solver is POTTR and args.mip_start:
+        start = time.perf_counter()
+        ilp_args['mip_start'] = solver_heuristic.find_heuristic_trajectory(conflicts, distinct, max(k_values))
+        log(f'Heuristic trajectory computed in {time.perf_counter() - start:.3f}s')
+
+    if args.k_range:
+        # one model for all k, each k gets its own output folder
+        trajectory_sizes = dict()
+        sweep = solver.find_max_k_common_trajectory_sweep(k_values=k_values, **ilp_args)
+        for k, node_selection_list, tree_selection_list in sweep:
+            if not node_selection_list:
+                continue
+            k_directory = os.path.join(directory, f'out_k{k}/')
+            os.makedirs(k_directory, exist_ok=True)
+            graph_selection_list = [[graphs[t] for t in cohort.expand_trees(trees, members)]
+                                    for trees in tree_selection_list]
+            trajectory_sizes[k] = write_trajectories(node_selection_list, graph_selection_list, cohort,
+                                                     k_directory, args, count_cache)
+        return trajectory_sizes
+
+    node_selection_list, tree_selection_list = solver.find_max_k_common_trajectory(k=k, **ilp_args)
+    if not node_selection_list:
+        return 0
+    graph_selection_list = [[graphs[t] for t in cohort.expand_trees(trees, members)] for trees in tree_selection_list]
+    return write_trajectories(node_selection_list, graph_selection_list, cohort, directory, args, count_cache)
+
+
+def write_trajectories(node_selection_list: list, graph_selection_list: list, cohort: Cohort, directory: str,
+                       args: argparse.Namespace, count_cache: str=''):
     """
     build trajectory from selected graphs and nodes; since conflict graph has no information about original edges,
     we need to infer them from the selected graphs
@@ -217,9 +321,9 @@ def main():
     # filter out duplicate results reported by ILP
     trajectories = filter_duplicates(trajectories)
     log('Compute support')
-    support_file = compute_support.compute_support(trajectories, graphs_dict, directory)
+    support_file, support_rows = compute_support.compute_support(trajectories, cohort, directory)
     log('Convert to output format')
-    converted_file = convert_to_mastro_format.convert(support_file, directory)
+    converted_file, converted_rows = convert_to_mastro_format.convert_rows(support_rows, directory)
 
     gexf_directory = os.path.join(directory, 'trajectories_gexf/')
     os.makedirs(gexf_directory, exist_ok=True)
@@ -240,12 +344,16 @@ def main():
         log('Draw trajectories')
         draw_trajectory_graph(converted_file, directory)
 
-    # run MASTRO significance test if trajectories are small enough, e.g. fewer than 10 nodes
-    if len(trajectories[0].nodes) < 13:
+    # run MASTRO significance test if trajectories are small enough, embeddings and automorphisms are counted without
+    # enumerating node subsets
+    if not args.significance_max_nodes or len(trajectories[0].nodes) < args.significance_max_nodes:
         log('Run significance test')
         results_significance = os.path.join(directory, 'significance_output.txt')
-        compute_significance.run_stat_significancce_test(support_file=converted_file, graph_file=dags,
-                                                         output_file=results_significance, cores=args.cores)
+        # trajectories and the cohort are passed on in memory, the written files are not read again
+        compute_significance.run_stat_significancce_test(support_file=converted_file, graph_file=args.dags,
+                                                         output_file=results_significance, cores=args.cores,
+                                                         count_cache=count_cache, trajectories=converted_rows,
+                                                         cohort=cohort)
     else:
         print('Trajectory size is too large to execute the significance test.')
 
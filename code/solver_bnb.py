@@ -0,0 +1,126 @@
+# ---------------------------------------------------------------------------- #
+#                                    IMPORTS                                   #
+# ---------------------------------------------------------------------------- #
+import time
+from cohort import Cohort
+from conflict_store import ConflictStore
+
+
+# ---------------------------------------------------------------------------- #
+#                                   FUNCTIONS                                  #
+# ---------------------------------------------------------------------------- #
+def get_search_tables(conflicts: ConflictStore, cohort: Cohort):
+    """
+    Bitset tables of the branch and bound over the nodes of the conflict graph: the bitset of trees containing each node,
+    the bitset and weight of the trees of each patient, the trees of other patients compatible with each tree and the
+    conflicting tree pairs of each node pair.
+    """
+    nodes = conflicts.nodes.tolist()
+    node_trees = [sum(1 << t for t in range(len(cohort)) if cohort.tree_nodes[t] >> v & 1) for v in nodes]
+    # a patient of a deduplicated cohort can stand for several patients
+    patient_masks = [(sum(1 << t for t in trees), weight) for trees, weight in zip(cohort.patient_trees,
+                                                                                  cohort.patient_weights())]
+    all_trees = (1 << len(cohort)) - 1
+    compatible = [all_trees & ~patient_masks[p][0] for p in cohort.tree_patient]
+
+    pair_conflicts = dict()
+    a, b, t1, t2 = conflicts.conflicts()
+    for u, v, g1, g2 in zip(a.tolist(), b.tolist(), t1.tolist(), t2.tolist()):
+        pair_conflicts.setdefault((u, v), []).append((g1, g2))
+    return nodes, node_trees, patient_masks, compatible, pair_conflicts
+
+
+def count_patients(trees: int, patient_masks: list):
+    return sum(weight for mask, weight in patient_masks if trees & mask)
+
+
+def find_compatible_trees(candidates: int, compatible: list, need: int, patient_masks: list):
+    # lowest pairwise compatible trees of distinct patients among the candidates or None, i.e. a clique of weight need
+    if need <= 0:
+        return []
+    while candidates and count_patients(candidates, patient_masks) >= need:
+        t = (candidates & -candidates).bit_length() - 1
+        candidates ^= 1 << t
+        weight = count_patients(1 << t, patient_masks)
+        rest = find_compatible_trees(candidates & compatible[t], compatible, need - weight, patient_masks)
+        if rest is not None:
+            return [t] + rest
+    return None
+
+
+def branch_and_bound(conflicts: ConflictStore, cohort: Cohort, k: int, lower_bound: int=0):
+    """
+    Exact search over node subsets in the order of the conflict graph nodes. A node set is feasible if pairwise
+    compatible trees of k distinct patients contain it, where patients of a deduplicated cohort are counted with their
+    weight; feasibility is closed under subsets, so only feasible sets are extended. A branch is cut if the set plus
+    all later nodes occurring in k patients of the remaining trees cannot reach the best size (or lower_bound, a known
+    lower bound on the optimum). Returns all maximum node sets (as ids) and trees selected for each.
+    """
+    nodes, node_trees, patient_masks, compatible, pair_conflicts = get_search_tables(conflicts, cohort)
+    best = [max(lower_bound, 0), [], []]
+
+    def search(start: int, selected: list, candidates: int, compatible: list, trees: list):
+        if len(selected) > best[0]:
+            best[:] = [len(selected), [], []]
+        if len(selected) == best[0]:
+            best[1].append(list(selected))
+            best[2].append(trees)
+
+        viable = [j for j in range(start, len(nodes))
+                  if count_patients(candidates & node_trees[j], patient_masks) >= k]
+        for i, j in enumerate(viable):
+            if len(selected) + len(viable) - i < best[0]:
+                break
+            v = nodes[j]
+            extended = candidates & node_trees[j]
+            # tree pairs in conflict for v and a selected node are no longer compatible
+            extended_compatible = list(compatible)
+            for u in selected:
+                for g1, g2 in pair_conflicts.get((min(u, v), max(u, v)), ()):
+                    extended_compatible[g1] &= ~(1 << g2)
+                    extended_compatible[g2] &= ~(1 << g1)
+            extended_trees = find_compatible_trees(extended, extended_compatible, k, patient_masks)
+            if extended_trees is not None:
+                search(j + 1, selected + [v], extended, extended_compatible, extended_trees)
+
+    all_trees = (1 << len(cohort)) - 1
+    trees = find_compatible_trees(all_trees, compatible, k, patient_masks)
+    if trees is not None:
+        search(0, [], all_trees, compatible, trees)
+    return best[0], best[1], best[2]
+
+
+def get_solutions(size: int, node_sets: list, tree_sets: list, mutations: list):
+    # maximum node sets in the format of POTTR.get_solutions
+    if not node_sets:
+        print('No trajectory found, k is larger than the number of compatible patients')
+        return [], []
+    print('Size of a maximum trajectory for this instance is ', size)
+    return [sorted(mutations[v] for v in nodes) for nodes in node_sets], tree_sets
+
+
+def find_max_k_common_trajectory(conflicts: ConflictStore, cohort: Cohort, k: int, cores: int, solution_pool_size: int=0,
+                                 verbose: bool=False, builder: str='matrix', names: bool=False, presolve: bool=True):
+    """
+    Same interface as POTTR.find_max_k_common_trajectory, solved by a branch and bound over node subsets instead of an
+    ILP. Meant for small universes of mutations or cell types, e.g. tens of nodes; all maximum trajectories are
+    returned, the other arguments are not used.
+    """
+    start = time.perf_counter()
+    size, node_sets, tree_sets = branch_and_bound(conflicts, cohort, k)
+    print(f'Branch and bound: {time.perf_counter() - start:.3f}s, {len(conflicts.nodes)} nodes, {len(cohort)} graphs')
+    return get_solutions(size, node_sets, tree_sets, conflicts.mutations)
+
+
+def find_max_k_common_trajectory_sweep(conflicts: ConflictStore, cohort: Cohort, k_values: list, cores: int,
+                                       solution_pool_size: int=0, verbose: bool=False, builder: str='matrix',
+                                       names: bool=False, presolve: bool=True):
+    # same interface as POTTR.find_max_k_common_trajectory_sweep, the optimum of k + 1 is a lower bound for k
+    lower_bound = 0
+    for k in sorted(set(k_values), reverse=True):
+        start = time.perf_counter()
+        size, node_sets, tree_sets = branch_and_bound(conflicts, cohort, k, lower_bound)
+        print(f'Solved k={k} in {time.perf_counter() - start:.3f}s')
+        if node_sets:
+            lower_bound = size
+        yield (k,) + get_solutions(size, node_sets, tree_sets, conflicts.mutations)
@@ -0,0 +1,151 @@
+# ---------------------------------------------------------------------------- #
+#                                    IMPORTS                                   #
+# ---------------------------------------------------------------------------- #
+import time
+import numpy as np
+from cohort import Cohort, iter_bits
+from conflict_store import ConflictStore
+
+
+# ---------------------------------------------------------------------------- #
+#                                   FUNCTIONS                                  #
+# ---------------------------------------------------------------------------- #
+def grow_tree_set(seed: int, cohort: Cohort, node_mask: int, k: int):
+    # greedily add trees of new patients that keep the most common nodes, starting from the seed tree, until the trees
+    # stand for k patients
+    trees = [seed]
+    patients = {cohort.tree_patient[seed]}
+    common = cohort.tree_nodes[seed] & node_mask
+    while sum(cohort.tree_weights[t] for t in trees) < k:
+        best, best_common = None, -1
+        for t in range(len(cohort)):
+            if cohort.tree_patient[t] in patients:
+                continue
+            overlap = bin(common & cohort.tree_nodes[t]).count('1')
+            if overlap > best_common:
+                best, best_common = t, overlap
+        if best is None:
+            return None
+        trees.append(best)
+        patients.add(cohort.tree_patient[best])
+        common &= cohort.tree_nodes[best]
+    return trees
+
+
+def get_tree_pair_conflicts(conflicts: ConflictStore):
+    # conflicting node pairs of each tree pair, computed once so that tree sets only touch the conflicts of their pairs
+    order = np.argsort(conflicts.tree_pairs, kind='stable')
+    tree_pairs, pairs = conflicts.tree_pairs[order], conflicts.pairs[order]
+    starts = np.flatnonzero(np.r_[True, tree_pairs[1:] != tree_pairs[:-1]]) if len(tree_pairs) else []
+    ends = np.r_[starts[1:], len(tree_pairs)]
+    return {int(tree_pairs[s]): pairs[s:e] for s, e in zip(starts, ends)}
+
+
+def conflicting_pairs(conflicts: ConflictStore, tree_pair_conflicts: dict, trees: list, others: list):
+    # conflicting node pairs of all pairs of a tree of trees and a tree of others
+    first, second = np.meshgrid(np.asarray(trees, dtype=np.int64), np.asarray(others, dtype=np.int64), indexing='ij')
+    keep = first != second
+    codes = conflicts.encode_tree_pairs(first[keep], second[keep]).tolist()
+    return [tree_pair_conflicts[c] for c in set(codes) if c in tree_pair_conflicts]
+
+
+def independent_nodes(conflicts: ConflictStore, cohort: Cohort, trees: list, node_mask: int, pairs: list):
+    """
+    Greedy maximum independent set of the nodes common to all trees in the conflict graph restricted to the tree pairs of
+    the trees, whose conflicting node pairs are given as arrays: the node of minimal degree is selected and its
+    neighbours are removed until no node is left.
+    """
+    common = node_mask
+    for t in trees:
+        common &= cohort.tree_nodes[t]
+    a, b = conflicts.decode_pairs(np.concatenate(pairs) if pairs else np.zeros(0, dtype=np.int64))
+
+    neighbours = {v: set() for v in iter_bits(common)}
+    for u, v in zip(a.tolist(), b.tolist()):
+        if u in neighbours and v in neighbours:
+            neighbours[u].add(v)
+            neighbours[v].add(u)
+
+    independent = []
+    while neighbours:
+        v = min(neighbours, key=lambda n: (len(neighbours[n]), n))
+        independent.append(v)
+        for u in neighbours.pop(v) & neighbours.keys():
+            for w in neighbours.pop(u):
+                if w in neighbours:
+                    neighbours[w].discard(u)
+    return sorted(independent)
+
+
+def find_heuristic_trajectory(conflicts: ConflictStore, cohort: Cohort, k: int, num_seeds: int=10,
+                              num_alternatives: int=5):
+    """
+    Heuristic trajectory of the trees of k patients: tree sets are grown greedily from the trees with most shared nodes as seeds, their
+    nodes are chosen by a greedy independent set on the restricted conflict graph. The best tree set is improved by a
+    local search that replaces single trees by the trees of other patients with the largest overlap. Returns the node
+    ids and trees of the best trajectory or None if there are not k patients.
+    """
+    if sum(cohort.patient_weights()) < k:
+        return None
+    node_mask = sum(1 << v for v in conflicts.nodes.tolist())
+    seeds = sorted(range(len(cohort)), key=lambda t: -bin(cohort.tree_nodes[t] & node_mask).count('1'))[:num_seeds]
+
+    tree_pair_conflicts = get_tree_pair_conflicts(conflicts)
+
+    best_nodes, best_trees = [], None
+    for seed in seeds:
+        trees = grow_tree_set(seed, cohort, node_mask, k)
+        if trees is None:
+            continue
+        nodes = independent_nodes(conflicts, cohort, trees, node_mask,
+                                  conflicting_pairs(conflicts, tree_pair_conflicts, trees, trees))
+        if best_trees is None or len(nodes) > len(best_nodes):
+            best_nodes, best_trees = nodes, trees
+
+    # local search: replace single trees as long as the trajectory grows, the conflicts among the kept trees are shared
+    # by all replacements
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(best_trees)):
+            others = best_trees[:i] + best_trees[i + 1:]
+            common = node_mask
+            for t in others:
+                common &= cohort.tree_nodes[t]
+            patients = {cohort.tree_patient[t] for t in others}
+            weight = sum(cohort.tree_weights[t] for t in others)
+            candidates = [t for t in range(len(cohort)) if cohort.tree_patient[t] not in patients and t != best_trees[i]
+                          and weight + cohort.tree_weights[t] >= k]
+            candidates.sort(key=lambda t: -bin(common & cohort.tree_nodes[t]).count('1'))
+            other_pairs = conflicting_pairs(conflicts, tree_pair_conflicts, others, others)
+            for t in candidates[:num_alternatives]:
+                trees = others[:i] + [t] + others[i:]
+                nodes = independent_nodes(conflicts, cohort, trees, node_mask,
+                                          other_pairs + conflicting_pairs(conflicts, tree_pair_conflicts, [t], others))
+                if len(nodes) > len(best_nodes):
+                    best_nodes, best_trees, improved = nodes, trees, True
+                    break
+    return best_nodes, sorted(best_trees)
+
+
+def find_max_k_common_trajectory(conflicts: ConflictStore, cohort: Cohort, k: int, cores: int, solution_pool_size: int=0,
+                                 verbose: bool=False, builder: str='matrix', names: bool=False, presolve: bool=True):
+    """
+    Same interface as POTTR.find_max_k_common_trajectory with the heuristic trajectory as single solution, which is not
+    necessarily maximum. The other arguments are not used.
+    """
+    start = time.perf_counter()
+    solution = find_heuristic_trajectory(conflicts, cohort, k)
+    if solution is None:
+        print('No trajectory found, k is larger than the number of patients')
+        return [], []
+    nodes, trees = solution
+    print(f'Heuristic: {time.perf_counter() - start:.3f}s, trajectory of size {len(nodes)} (not necessarily maximum)')
+    return [sorted(conflicts.mutations[v] for v in nodes)], [trees]
+
+
+def find_max_k_common_trajectory_sweep(conflicts: ConflictStore, cohort: Cohort, k_values: list, cores: int,
+                                       solution_pool_size: int=0, verbose: bool=False, builder: str='matrix',
+                                       names: bool=False, presolve: bool=True):
+    for k in sorted(set(k_values), reverse=True):
+        yield (k,) + find_max_k_common_trajectory(conflicts, cohort, k, cores)
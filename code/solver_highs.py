@@ -0,0 +1,95 @@
+# ---------------------------------------------------------------------------- #
+#                                    IMPORTS                                   #
+# ---------------------------------------------------------------------------- #
+import time
+import resource
+import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import milp, LinearConstraint, Bounds
+from cohort import Cohort
+from conflict_store import ConflictStore
+from POTTR import get_model_arrays
+
+
+# ---------------------------------------------------------------------------- #
+#                                   FUNCTIONS                                  #
+# ---------------------------------------------------------------------------- #
+def build_model(conflicts: ConflictStore, cohort: Cohort, k: int, drop_trees: bool=True, presolve: bool=True):
+    """
+    Model of POTTR.get_model_arrays for scipy.optimize.milp: objective, matrix and upper bounds of all constraints except
+    sum(weight_g * y_g) >= k, the row of this constraint and the node ids and graph indices of the variables.
+    """
+    start = time.perf_counter()
+    node_ids, tree_ids, num_shared, constraints = get_model_arrays(conflicts, cohort, k, drop_trees, presolve)
+    num_variables = len(node_ids) + len(tree_ids) + num_shared
+
+    # milp minimizes, the objective is the negated number of selected nodes
+    objective = np.zeros(num_variables)
+    objective[:len(node_ids)] = -1
+    matrix = sp.vstack([sp.csr_matrix((0, num_variables))] + [matrix for _, matrix, _ in constraints], format='csr')
+    upper = np.concatenate([np.zeros(0)] + [np.full(matrix.shape[0], rhs, dtype=float) for _, matrix, rhs in constraints])
+    # graphs of a deduplicated cohort count for all patients they stand for
+    weights = np.asarray(cohort.tree_weights, dtype=float)[tree_ids]
+    k_row = sp.csr_matrix((weights, (np.zeros(len(tree_ids), dtype=np.int64),
+                                     len(node_ids) + np.arange(len(tree_ids)))), shape=(1, num_variables))
+    print(f'Model build (highs): {time.perf_counter() - start:.2f}s, {num_variables} variables, '
+          f'{matrix.shape[0] + 1} constraints, peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+
+    return objective, matrix, upper, k_row, node_ids, tree_ids
+
+
+def solve(model: tuple, k: int, verbose: bool=False, time_limit: float=None):
+    # scipy result of the model for at least k graphs
+    objective, matrix, upper, k_row, node_ids, tree_ids = model
+    constraints = [LinearConstraint(k_row, k, np.inf)]
+    if matrix.shape[0]:
+        constraints.append(LinearConstraint(matrix, -np.inf, upper))
+    options = {'disp': verbose}
+    if time_limit:
+        options['time_limit'] = time_limit
+    return milp(objective, constraints=constraints, integrality=np.ones(len(objective)), bounds=Bounds(0, 1),
+                options=options)
+
+
+def get_solutions(result, model: tuple, mutations: list):
+    # HiGHS reports a single optimal solution, returned in the format of POTTR.get_solutions
+    node_ids, tree_ids = model[4], model[5]
+    if result.status != 0:
+        print(f'No optimal solution found by HiGHS: {result.message}')
+        return [], []
+
+    selected = result.x > 0.5
+    node_selection = [sorted(mutations[v] for v in node_ids[selected[:len(node_ids)]])]
+    graph_selection = [tree_ids[selected[len(node_ids):len(node_ids) + len(tree_ids)]].tolist()]
+    print('Size of a maximum trajectory for this instance is ', len(node_selection[0]))
+    return node_selection, graph_selection
+
+
+def find_max_k_common_trajectory(conflicts: ConflictStore, cohort: Cohort, k: int, cores: int, solution_pool_size: int=0,
+                                 verbose: bool=False, builder: str='matrix', names: bool=False, presolve: bool=True):
+    """
+    Same interface as POTTR.find_max_k_common_trajectory with HiGHS as solver. HiGHS runs single threaded and returns
+    one optimal solution, so cores, builder, names and the pool size are not used.
+    """
+    if solution_pool_size > 0:
+        print('HiGHS has no solution pool, only one maximum trajectory is reported')
+    model = build_model(conflicts, cohort, k, presolve=presolve)
+    return get_solutions(solve(model, k, verbose), model, conflicts.mutations)
+
+
+def find_max_k_common_trajectory_sweep(conflicts: ConflictStore, cohort: Cohort, k_values: list, cores: int,
+                                       solution_pool_size: int=0, verbose: bool=False, builder: str='matrix',
+                                       names: bool=False, presolve: bool=True):
+    # same interface as POTTR.find_max_k_common_trajectory_sweep, the model is built once (without dropping graphs, see
+    # POTTR.presolve) but every k is solved cold
+    if solution_pool_size > 0:
+        print('HiGHS has no solution pool, only one maximum trajectory is reported')
+    k_values = sorted(set(k_values), reverse=True)
+    if not k_values:
+        return
+    model = build_model(conflicts, cohort, k_values[-1], drop_trees=False, presolve=presolve)
+    for k in k_values:
+        start = time.perf_counter()
+        result = solve(model, k, verbose)
+        print(f'Solved k={k} in {time.perf_counter() - start:.2f}s')
+        yield (k,) + get_solutions(result, model, conflicts.mutations)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of POTTR are imported from the code directory, as by the scripts run there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
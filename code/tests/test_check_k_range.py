@@ -0,0 +1,32 @@
+import pytest
+from cohort import Cohort
+from check_k_range import get_k_values, compare_sweep
+from compute_conflict_graph import get_pair_free_conflict_graph
+
+
+def duplicated_cohort():
+    # six patients, four of them with the same tree, which deduplicate merges into one weighted tree
+    cohort = Cohort()
+    for patient in range(4):
+        cohort.add_tree(str(patient), f'{patient}-0', ['a', 'b', 'c'], [('a', 'b'), ('a', 'c')])
+    cohort.add_tree('4', '4-0', ['a', 'b', 'd'], [('a', 'b'), ('b', 'd')])
+    cohort.add_tree('5', '5-0', ['a', 'c', 'd'], [('c', 'a'), ('a', 'd')])
+    return cohort.deduplicate()[0]
+
+
+def test_k_values_count_input_patients():
+    cohort = duplicated_cohort()
+    assert len(cohort.patients) == 3
+    assert list(get_k_values(cohort, 1, 10)) == [1, 2, 3, 4, 5, 6]
+    assert list(get_k_values(cohort, 0, 5)) == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize('solver_name', ['highs', 'bnb'])
+def test_sweep_up_to_all_patients(solver_name):
+    cohort = duplicated_cohort()
+    conflicts = get_pair_free_conflict_graph(cohort)
+    results = list(compare_sweep(conflicts, cohort, get_k_values(cohort, 1, 10), solver_name))
+    assert [k for k, _, _, _ in results] == [6, 5, 4, 3, 2, 1]
+    assert all(same for _, _, _, same in results)
+    sizes = {k: size for k, size, _, _ in results}
+    assert sizes[6] == 2 and sizes[4] == 4
@@ -0,0 +1,94 @@
+import itertools
+import random
+import networkx as nx
+from MASTRO_significance_test.compute_significance import compute_num_automorph, count_induced_subposets, \
+    canonical_shape
+
+CASES = 100
+
+
+def random_dag(rng: random.Random, num_nodes: int, p: float, names: list=None, closed: bool=True):
+    # DAG over num_nodes mutations below the root '0', optionally transitively closed
+    names = names or [str(i) for i in range(1, num_nodes + 1)]
+    graph = nx.DiGraph()
+    graph.add_nodes_from(names[:num_nodes])
+    for i, j in itertools.combinations(range(num_nodes), 2):
+        if rng.random() < p:
+            graph.add_edge(names[i], names[j])
+    graph.add_node('0')
+    graph.add_edges_from(('0', n) for n in names[:num_nodes])
+    return nx.transitive_closure_dag(graph) if closed else graph
+
+
+def symmetric_dag(rng: random.Random, max_nodes: int):
+    # disjoint copies of one closed piece below the root, the cases with many automorphisms
+    piece = random_dag(rng, rng.randint(1, 3), 0.5)
+    graph = nx.DiGraph()
+    graph.add_node('0')
+    for c in range(rng.randint(1, max(1, max_nodes // (len(piece) - 1)))):
+        mapping = {n: n if n == '0' else f'{n}_{c}' for n in piece}
+        graph.add_nodes_from(mapping.values())
+        graph.add_edges_from((mapping[u], mapping[v]) for u, v in piece.edges)
+    return graph
+
+
+def brute_force_automorph(trajectory: nx.DiGraph):
+    # permutations of the mutations that map the edges onto themselves
+    nodes = [n for n in trajectory if n != '0']
+    edges = set(trajectory.edges)
+    count = 0
+    for permutation in itertools.permutations(nodes):
+        mapping = dict(zip(nodes, permutation), **{'0': '0'})
+        if {(mapping[u], mapping[v]) for u, v in edges} == edges:
+            count += 1
+    return count
+
+
+def brute_force_induced_subposets(trajectory: nx.DiGraph, graph_: nx.DiGraph):
+    # subsets of the mutations of graph_ whose induced subposet is isomorphic to the trajectory
+    nodes = [n for n in graph_ if n != '0']
+    count = 0
+    for subset in itertools.combinations(nodes, len(trajectory) - 1):
+        if nx.is_isomorphic(graph_.subgraph(list(subset) + ['0']), trajectory):
+            count += 1
+    return count
+
+
+def test_automorphisms():
+    rng = random.Random(0)
+    for i in range(CASES):
+        if i % 3 == 2:
+            trajectory = symmetric_dag(rng, 6)
+        else:
+            trajectory = random_dag(rng, rng.randint(0, 6), rng.random() * 0.6, closed=rng.random() < 0.7)
+        assert compute_num_automorph(trajectory) == brute_force_automorph(trajectory), sorted(trajectory.edges)
+
+
+def test_induced_subposets():
+    rng = random.Random(1)
+    names = [str(i) for i in range(1, 20)]
+    for _ in range(CASES):
+        num_nodes = rng.randint(1, 7)
+        size = rng.randint(0, min(num_nodes, 4))
+        graph_ = random_dag(rng, num_nodes, rng.random(), rng.sample(names, len(names)))
+        if rng.random() < 0.5:
+            # a subposet of the graph, so that most cases have at least one embedding
+            subset = rng.sample([n for n in graph_ if n != '0'], size)
+            trajectory = graph_.subgraph(subset + ['0']).copy()
+        else:
+            trajectory = random_dag(rng, size, rng.random(), names)
+        assert count_induced_subposets(trajectory, graph_) == brute_force_induced_subposets(trajectory, graph_), \
+            (sorted(trajectory.edges), sorted(graph_.edges))
+
+
+def test_shapes():
+    # canonical shapes are equal exactly for isomorphic DAGs
+    rng = random.Random(2)
+    for i in range(CASES):
+        graph_ = symmetric_dag(rng, 6) if i % 3 == 2 else random_dag(rng, rng.randint(0, 6), rng.random())
+        nodes = [n for n in graph_ if n != '0']
+        relabelled = nx.relabel_nodes(graph_, dict(zip(nodes, rng.sample(nodes, len(nodes)))))
+        other = random_dag(rng, len(nodes), rng.random())
+        assert canonical_shape(graph_) == canonical_shape(relabelled), sorted(graph_.edges)
+        assert (canonical_shape(graph_) == canonical_shape(other)) == nx.is_isomorphic(graph_, other), \
+            (sorted(graph_.edges), sorted(other.edges))